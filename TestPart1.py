@@ -6,7 +6,7 @@ import time
 import random
 import signal
 import util
-from testspart1 import MessageTest1, MessageTest2, SingleClientTest, BasicTest, MultipleClientsTest, ErrorHandlingTest, ListUsersTest 
+from testspart1 import MessageTest1, MessageTest2, SingleClientTest, BasicTest, MultipleClientsTest, ErrorHandlingTest, ListUsersTest, OfflineDeliveryTest, HistoryTest, FileResumeTest, WorkersTest, SelectorEngineTest
 
 
 def tests_to_run(forwarder):
@@ -16,6 +16,11 @@ def tests_to_run(forwarder):
     SingleClientTest.SingleClientTest(forwarder, "SingleClient")
     MultipleClientsTest.MultipleClientsTest(forwarder, "MultipleClients")
     ErrorHandlingTest.ErrorHandlingTest(forwarder, "ErrorHandling")
+    OfflineDeliveryTest.OfflineDeliveryTest(forwarder, "OfflineDelivery")
+    HistoryTest.HistoryTest(forwarder, "History")
+    FileResumeTest.FileResumeTest(forwarder, "FileResume")
+    WorkersTest.WorkersTest(forwarder, "Workers")
+    SelectorEngineTest.SelectorEngineTest(forwarder, "SelectorEngine")
 
 class Forwarder(object):
     def __init__(self, sender_path, receiver_path, port):
@@ -78,7 +83,9 @@ class Forwarder(object):
             self.start()
 
     def handle_receive(self, message, address, user):
-        if address[1] == self.receiver_port and user in self.sender_addr:
+        if address[1] == self.receiver_port:
+            if user not in self.sender_addr:
+                return # for a client that was restarted and did not send yet
             p = Packet(message, self.sender_addr[user])
         else:
             if user not in self.sender_addr:
@@ -88,6 +95,24 @@ class Forwarder(object):
         self.in_queue.append((p, user))
         self.current_test.handle_packet()
 
+    def _start_sender(self, client):
+        self.senders[client] = subprocess.Popen([
+            "python3", self.sender_path, "-p",
+            str(self.cli_ports[client]), "-u", client
+        ] + self.current_test.client_args,
+                                                stdin=subprocess.PIPE,
+                                                stdout=self.sender_out[client])
+
+    def kill(self, client):
+        self.senders[client].kill()
+        self.senders[client].wait()
+
+    def restart(self, client):
+        # the new process sends from a port of its own, but through the same middle
+        # socket: the server sees it join again from the same address
+        self.sender_addr.pop(client, None)
+        self._start_sender(client)
+
     def start(self):
         self.sender_addr = {}
         self.receiver_addr = ('127.0.0.1', self.receiver_port)
@@ -96,19 +121,16 @@ class Forwarder(object):
         recv_out = open(self.recv_outfile, "w")
         receiver = subprocess.Popen(
             ["python3", self.receiver_path, "-p",
-             str(self.receiver_port)],
+             str(self.receiver_port)] + self.current_test.server_args,
             stdout=recv_out)
         time.sleep(0.2)  # make sure the receiver is started first
         self.senders = {}
-        sender_out = {}
+        self.sender_out = {}
+        sender_out = self.sender_out
         for i in list(self.current_test.client_stdin.keys()):
             sender_out[i] = open("client_" + i, "w")
-            self.senders[i] = subprocess.Popen([
-                "python3", self.sender_path, "-p",
-                str(self.cli_ports[i]), "-u", i
-            ],
-                                               stdin=subprocess.PIPE,
-                                               stdout=sender_out[i])
+            self._start_sender(i)
+        timeout = self.current_test.timeout or self.timeout
         try:
             start_time = time.time()
             while None in [self.senders[s].poll() for s in self.senders]:
@@ -121,7 +143,7 @@ class Forwarder(object):
                     if time.time() - self.last_tick > self.tick_interval:
                         self.last_tick = time.time()
                         self._tick()
-                    if time.time() - start_time > self.timeout:
+                    if time.time() - start_time > timeout:
                         raise Exception("Test timed out!")
             self._tick()
         except (KeyboardInterrupt, SystemExit):
@@ -0,0 +1,1056 @@
+'''
+This module contains micro-benchmarks for the chat application.
+Run `python3 bench.py` to run all of them or `python3 bench.py <name> ...` to run some.
+'''
+import os
+import random
+import select
+import selectors
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import zlib
+import util
+from parsing import parse_message, unbatch
+from bulkio import BulkSocket
+from eventlog import EventLog
+from timerwheel import TimingWheel
+from sessions import SessionRegistry
+from offlinequeue import OfflineQueue
+from history import HistoryStore
+from transport import ReliableTransport, encode
+from filetransfer import FileSink, file_digest, map_file
+from server_1 import Server, DRAIN_BATCH
+from client_1 import Client
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    '''
+    Registers a benchmark under the name of the function
+    '''
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def ns_per_op(stmt, number):
+    '''
+    Returns the best-of-three cost of calling stmt, in nanoseconds per call
+    '''
+    return min(timeit.repeat(stmt, number=number, repeat=3)) / number * 1e9
+
+
+def make_addresses(count):
+    '''
+    Returns count distinct fake client addresses
+    '''
+    return [("10.%d.%d.%d" % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), 10000 + i % 30000)
+            for i in range(count)]
+
+
+@benchmark
+def sessions():
+    '''
+    Per-packet cost of finding the sender of a datagram, list scan vs registry lookup
+    '''
+    print("%10s %18s %18s" % ("sessions", "list scan ns/pkt", "registry ns/pkt"))
+    for count in (10, 1000, 50000):
+        addresses = make_addresses(count)
+        table = {}
+        registry = SessionRegistry()
+        for i, address in enumerate(addresses):
+            table["user%d" % i] = address
+            registry.insert("user%d" % i, address)
+        client = addresses[-1] # worst case for the scan
+
+        def list_scan():
+            key_list = list(table.keys())
+            val_list = list(table.values())
+            return key_list[val_list.index(client)]
+
+        def registry_lookup():
+            return registry.username_of(client)
+
+        number = max(10, 200000 // count)
+        print("%10d %18.0f %18.0f" % (count, ns_per_op(list_scan, number),
+                                       ns_per_op(registry_lookup, 200000)))
+
+
+@benchmark
+def sessionmemory():
+    '''
+    Bytes retained per session and join/lookup cost, dict vs registry, and per transport peer
+    '''
+    def retained(build):
+        # bytes still allocated once build() returned, divided by the sessions
+        tracemalloc.start()
+        table = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del table
+        return size
+
+    print("%10s %15s %15s %10s %10s %10s" % ("sessions", "dict B/session", "table B/session",
+                                             "join ns", "lookup ns", "addr ns"))
+    for count in (1000, 10000, 100000):
+        # every address and username arrives as a fresh object decoded from a datagram
+        def original():
+            table = {}
+            for name, address in zip(("user%d" % i for i in range(count)), make_addresses(count)):
+                table[name] = address
+            return table
+
+        def compact():
+            registry = SessionRegistry()
+            for name, address in zip(("user%d" % i for i in range(count)), make_addresses(count)):
+                registry.insert(name, address, 0.0)
+            return registry
+
+        names = ["user%d" % i for i in range(count)]
+        addresses = make_addresses(count)
+        registry = compact()
+
+        def join_all():
+            fresh = SessionRegistry()
+            for name, address in zip(names, addresses):
+                fresh.insert(name, address, 0.0)
+
+        client = addresses[count // 2]
+        print("%10d %15.0f %15.0f %10.0f %10.0f %10.0f" % (
+            count, retained(original) / count, retained(compact) / count,
+            ns_per_op(join_all, 1) / count,
+            ns_per_op(lambda: registry.username_of(client), 100000),
+            ns_per_op(lambda: registry.address_of("user1"), 100000)))
+
+    def peers(count, acked):
+        # a chat line to every peer, acknowledged by all of them or still in flight
+        transport = ReliableTransport(NullSocket(), 3)
+        addresses = make_addresses(count)
+        transport.send_many(addresses, util.make_message(
+            util.FORWARD_MESSAGE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT, "1 user0 hello"))
+        if acked:
+            for address in addresses:
+                # ack everything sent so far, until the end packet is acked
+                while address in transport.outgoing:
+                    conn = transport.outgoing[address]
+                    transport.handle_packet(util.make_packet_bytes(
+                        util.ACK_PACKET_TYPE, conn.isn + conn.next), address)
+        return transport
+
+    print()
+    print("%10s %18s %18s" % ("peers", "in flight B/peer", "acked B/peer"))
+    for count in (1000, 10000, 100000):
+        print("%10d %18.0f %18.0f" % (count, retained(lambda: peers(count, False)) / count,
+                                      retained(lambda: peers(count, True)) / count))
+
+
+@benchmark
+def idleexpiry():
+    '''
+    Cost of one expiry tick with 1% of the sessions due, full scan vs timing wheel
+    '''
+    timeout = util.IDLE_TIMEOUTS * util.TIME_OUT
+    print("%10s %16s %16s" % ("sessions", "scan us/tick", "wheel us/tick"))
+    for count in (1000, 10000, 100000):
+        registry = SessionRegistry()
+        for i, address in enumerate(make_addresses(count)):
+            # last seen spread over one timeout, so each tick finds a few stale ones
+            registry.insert("user%d" % i, address, i * timeout / count)
+        sessions = list(registry.sessions.values())
+        step = timeout / 100 # 1% of the sessions go stale per tick
+
+        def scan(now):
+            return [s for s in sessions if s.last_seen + timeout <= now]
+
+        def wheel_tick():
+            wheel = TimingWheel(step, 128, 0.0)
+            for session in sessions:
+                wheel.schedule(session, session.last_seen + timeout)
+            # one full timeout of ticks, every session expires once
+            start = time.perf_counter()
+            for t in range(100):
+                wheel.expire(timeout + (t + 1) * step)
+            return (time.perf_counter() - start) / 100
+
+        now = timeout + step
+        print("%10d %16.1f %16.1f" % (count, ns_per_op(lambda: scan(now), 3) / 1e3,
+                                       min(wheel_tick() for _ in range(3)) * 1e6))
+
+
+class CountingSocket:
+    '''
+    Socket wrapper counting the calls that end in a syscall
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+        self.syscalls = 0
+
+    def settimeout(self, timeout):
+        self.syscalls += 1 # ioctl(FIONBIO)
+        self.sock.settimeout(timeout)
+
+    def recvfrom(self, size):
+        self.syscalls += 2 # poll() then recvfrom() when a timeout is set
+        return self.sock.recvfrom(size)
+
+    def sendto(self, data, address):
+        self.syscalls += 1
+        return self.sock.sendto(data, address)
+
+
+@benchmark
+def bulkio():
+    '''
+    Syscalls, retained objects and time per datagram, per-datagram recvfrom vs batched I/O
+    '''
+    burst = 64
+    packet = util.make_packet_bytes(util.DATA_PACKET_TYPE, 1, b"x" * 100)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(("127.0.0.1", 0))
+    address = receiver.getsockname()
+    peer = sender.getsockname()
+
+    def old_loop(sock, kept):
+        for _ in range(burst):
+            sock.settimeout(util.TIME_OUT)
+            msg, client = sock.recvfrom(util.CHUNK_SIZE)
+            kept.append((msg, client))
+            sock.sendto(msg, peer)
+
+    def new_loop(io, kept):
+        io.wait(util.TIME_OUT)
+        while len(kept) < burst:
+            for msg, length, client in io.drain():
+                kept.append((length, client))
+                io.sendto(msg, peer)
+        io.flush()
+
+    results = []
+    for name, wrap, loop in (("recvfrom", CountingSocket, old_loop), ("bulk", BulkSocket, new_loop)):
+        receiver.setblocking(True)
+        sock = wrap(receiver)
+        kept = []
+        rounds = 50
+        elapsed = 0.0
+        blocks = 0
+        for _ in range(rounds):
+            for _ in range(burst):
+                sender.sendto(packet, address)
+            del kept[:]
+            before = sys.getallocatedblocks()
+            start = timeit.default_timer()
+            loop(sock, kept)
+            elapsed += timeit.default_timer() - start
+            blocks += sys.getallocatedblocks() - before
+            # empty the echoes so the sender buffer never fills
+            sender.setblocking(False)
+            try:
+                while True:
+                    sender.recv(util.CHUNK_SIZE)
+            except BlockingIOError:
+                pass
+            sender.setblocking(True)
+        datagrams = rounds * burst
+        results.append((name, sock.syscalls * 1.0 / datagrams, blocks * 1.0 / datagrams,
+                        elapsed / datagrams * 1e9))
+    print("%10s %22s %22s %12s" % ("path", "syscalls/datagram in+out", "objects kept/datagram", "ns/datagram"))
+    for name, syscalls, blocks, ns in results:
+        print("%10s %22.2f %22.2f %12.0f" % (name, syscalls, blocks, ns))
+
+
+class NullSocket:
+    '''
+    Socket that discards everything sent through it
+    '''
+    def sendto(self, data, address):
+        return len(data)
+
+
+class LossySocket:
+    '''
+    Socket wrapper that drops a fraction of the data packets sent through it, like
+    PacketLossTest does
+    '''
+    def __init__(self, sock, loss, seed=0):
+        self.sock = sock
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.sent = 0
+
+    def sendto(self, data, address):
+        self.sent += 1
+        is_data = data[:5] == b"data|" or data[0] == util.BINARY_TYPES[util.DATA_PACKET_TYPE]
+        if is_data and self.random.random() < self.loss:
+            return len(data)
+        return self.sock.sendto(data, address)
+
+
+def loopback_pair():
+    '''
+    Returns two UDP sockets bound on the loopback interface
+    '''
+    socks = []
+    for _ in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        socks.append(sock)
+    return socks
+
+
+def transfer(sender, receiver, messages):
+    '''
+    Sends the messages from one transport to the other, which must use the two
+    sockets of loopback_pair() (wrapped or not), driving both from this thread.
+    Returns the seconds each message took to be delivered.
+    '''
+    sender_sock = getattr(sender.sock, "sock", sender.sock)
+    receiver_sock = getattr(receiver.sock, "sock", receiver.sock)
+    destination = receiver_sock.getsockname()
+    latencies = []
+    for message in messages:
+        start = time.time()
+        sender.send(destination, message)
+        delivered = False
+        while not delivered or sender.busy():
+            timeouts = [t for t in (sender.next_timeout(), receiver.next_timeout()) if t is not None]
+            ready, _, _ = select.select([sender_sock, receiver_sock], [], [],
+                                        min(timeouts) if timeouts else None)
+            for sock, transport in ((receiver_sock, receiver), (sender_sock, sender)):
+                if sock in ready:
+                    data, address = sock.recvfrom(65535)
+                    if transport.handle_packet(data, address) is not None and not delivered:
+                        latencies.append(time.time() - start)
+                        delivered = True
+            sender.tick()
+            receiver.tick()
+    return latencies
+
+
+@benchmark
+def rto():
+    '''
+    Delivery time over loopback losing 30% of data, fixed vs adaptive retransmission timeout
+    '''
+    messages = ["x" * 5000] * 10
+    print("%10s %16s %16s %16s" % ("timeout", "mean ms/msg", "max ms/msg", "final rto ms"))
+    for adaptive in (False, True):
+        sender_sock, receiver_sock = loopback_pair()
+        sender = ReliableTransport(LossySocket(sender_sock, 0.3), 3, adaptive)
+        receiver = ReliableTransport(receiver_sock, 3, adaptive)
+        latencies = transfer(sender, receiver, messages)
+        stats = sender.rtt_stats(receiver_sock.getsockname())
+        print("%10s %16.1f %16.1f %16.1f" % ("adaptive" if adaptive else "fixed",
+                                             sum(latencies) / len(latencies) * 1e3,
+                                             max(latencies) * 1e3, stats["rto"] * 1e3))
+        sender_sock.close()
+        receiver_sock.close()
+
+
+@benchmark
+def timers():
+    '''
+    Cost of the transport's timers with many peers in flight, none of them due
+    '''
+    print("%10s %20s %14s" % ("in flight", "next_timeout us", "tick us"))
+    for peers in (10, 1000, 10000):
+        transport = ReliableTransport(NullSocket(), 8)
+        transport.send_many(make_addresses(peers), "x" * 5000)
+        print("%10d %20.2f %14.2f" % (peers, ns_per_op(transport.next_timeout, 2000) / 1000,
+                                      ns_per_op(transport.tick, 2000) / 1000))
+
+
+@benchmark
+def sack():
+    '''
+    Data packets sent over loopback losing 30% of data, cumulative acks vs SACK blocks
+    '''
+    messages = ["x" * 20000] * 10 # 15 fragments each
+    fragments = len(util.fragment(messages[0].encode()))
+    print("%8s %6s %14s %16s %14s" % ("acks", "window", "sent/fragment", "retransmitted",
+                                       "mean ms/msg"))
+    for window in (4, 16):
+        for sack in (False, True):
+            sender_sock, receiver_sock = loopback_pair()
+            lossy = LossySocket(sender_sock, 0.3)
+            sender = ReliableTransport(lossy, window)
+            receiver = ReliableTransport(receiver_sock, window, sack=sack)
+            latencies = transfer(sender, receiver, messages)
+            data_sent = lossy.sent - 2 * len(messages) # minus start and end packets
+            print("%8s %6d %14.2f %16d %14.1f" % ("sack" if sack else "cumul.", window,
+                                                  data_sent / (fragments * len(messages)),
+                                                  sender.retransmitted,
+                                                  sum(latencies) / len(latencies) * 1e3))
+            sender_sock.close()
+            receiver_sock.close()
+
+
+@benchmark
+def acks():
+    '''
+    Ack packets per data packet for request/reply traffic, immediate vs delayed acks
+    '''
+    request = util.make_message(util.REQUEST_USERS_LIST_MESSAGE, util.TYPE_TWO_MSG_FORMAT)
+    print("%8s %10s %14s %12s %12s %14s" % ("acks", "messages", "data received", "acks sent",
+                                            "piggybacked", "acks per data"))
+    for delayed in (False, True):
+        client_sock, server_sock = loopback_pair()
+        client = ReliableTransport(client_sock, 3, delayed_ack=delayed)
+        server = ReliableTransport(server_sock, 3, delayed_ack=delayed)
+        server_address = server_sock.getsockname()
+        count = 200
+        for i in range(count):
+            # a users list request answered with the list, then a message to forward
+            client.send(server_address, request if i % 2 else
+                        util.make_message(util.SEND_MESSAGE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                          "1 client2 " + "x" * 2000))
+            replied = False
+            while not replied or client.busy() or server.busy() \
+                    or client.pending_acks or server.pending_acks:
+                timeouts = [t for t in (client.next_timeout(), server.next_timeout())
+                            if t is not None]
+                ready, _, _ = select.select([client_sock, server_sock], [], [],
+                                            min(timeouts) if timeouts else None)
+                if server_sock in ready:
+                    data, address = server_sock.recvfrom(65535)
+                    message = server.handle_packet(data, address)
+                    if message is not None:
+                        server.send(address, util.make_message(
+                            util.RESPONSE_USERS_LIST_MESSAGE, util.TYPE_THREE_MSG_FORMAT,
+                            "client1 client2 client3"))
+                if client_sock in ready:
+                    data, address = client_sock.recvfrom(65535)
+                    if client.handle_packet(data, address) is not None:
+                        replied = True
+                client.tick()
+                server.tick()
+        data_received = client.data_received + server.data_received
+        acks_sent = client.acks_sent + server.acks_sent
+        piggybacked = client.acks_piggybacked + server.acks_piggybacked
+        print("%8s %10d %14d %12d %12d %14.2f" % ("delayed" if delayed else "immediate",
+                                                 2 * count, data_received, acks_sent,
+                                                 piggybacked, acks_sent / data_received))
+        client_sock.close()
+        server_sock.close()
+
+
+@benchmark
+def coalesce():
+    '''
+    Packets and delivery time for bursts of small forwards to one client, coalescing off/on
+    '''
+    bursts, burst = 20, 30
+    print("%10s %10s %12s %14s %14s %10s" % ("coalesce", "messages", "packets", "packets/msg",
+                                             "mean ms/msg", "batches"))
+    for coalesce in (False, True):
+        server_sock, client_sock = loopback_pair()
+        counted = LossySocket(server_sock, 0.0)
+        server = ReliableTransport(counted, 3, coalesce=coalesce)
+        client_counted = LossySocket(client_sock, 0.0)
+        client = ReliableTransport(client_counted, 3)
+        client_address = client_sock.getsockname()
+        latencies = []
+        for _ in range(bursts):
+            sent_at = {}
+            for i in range(burst):
+                # several senders talking at once, as seen by the recipient
+                message = util.make_message(util.FORWARD_MESSAGE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                            "1 sender%d message %d" % (i % 5, i))
+                sent_at[message.encode()] = time.time()
+                server.send(client_address, message)
+            while sent_at or server.busy() or server.holding:
+                timeouts = [t for t in (server.next_timeout(), client.next_timeout())
+                            if t is not None]
+                ready, _, _ = select.select([server_sock, client_sock], [], [],
+                                            min(timeouts) if timeouts else None)
+                if client_sock in ready:
+                    data, address = client_sock.recvfrom(65535)
+                    data = client.handle_packet(data, address)
+                    for part in unbatch(data) if data is not None else ():
+                        latencies.append(time.time() - sent_at.pop(bytes(part)))
+                if server_sock in ready:
+                    data, address = server_sock.recvfrom(65535)
+                    server.handle_packet(data, address)
+                server.tick()
+                client.tick()
+        packets = counted.sent + client_counted.sent
+        print("%10s %10d %12d %14.2f %14.2f %10d" % ("on" if coalesce else "off", len(latencies),
+                                                     packets, packets / len(latencies),
+                                                     sum(latencies) / len(latencies) * 1e3,
+                                                     server.batches))
+        server_sock.close()
+        client_sock.close()
+
+
+@benchmark
+def compression():
+    '''
+    Compression ratio, CPU cost and datagrams of chat text and harness-like payloads
+    '''
+    rand = random.Random(0)
+    words = ("the", "meeting", "is", "at", "five", "see", "you", "there", "ok", "thanks",
+             "did", "anyone", "get", "the", "notes", "from", "today", "lecture", "yes")
+    def chat(size):
+        text = ' '.join(rand.choice(words) for _ in range(size // 4))[:size]
+        return util.make_message(util.SEND_MESSAGE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                 "2 client1 client2 " + text)
+    def letters(size):
+        # the long message of PacketLossTest and the contents of test_file1/test_file2
+        return ''.join(rand.choice(string.ascii_letters) for _ in range(size))
+    payloads = (("chat line", chat(60)), ("chat paragraph", chat(600)),
+                ("long message", util.make_message(util.SEND_MESSAGE_MESSAGE,
+                                                   util.TYPE_FOUR_MSG_FORMAT,
+                                                   "1 client2 " + letters(5000))),
+                ("file 50KB", letters(50000)))
+    print("%16s %8s %8s %7s %11s %11s %12s" % ("payload", "bytes", "wire", "ratio",
+                                              "deflate us", "inflate us", "packets"))
+    for name, message in payloads:
+        encoded = encode(message)
+        deflated = encoded.compressed()
+        wire = len(deflated) if deflated is not None else len(encoded.payload)
+        deflate_us = ns_per_op(lambda: zlib.compress(encoded.payload, util.COMPRESS_LEVEL),
+                               200) / 1e3
+        inflate_us = ns_per_op(lambda: zlib.decompress(deflated), 200) / 1e3 if deflated else 0.0
+        print("%16s %8d %8d %7.2f %11.1f %11.1f %5d -> %4d" % (
+            name, len(encoded.payload), wire, wire / len(encoded.payload), deflate_us, inflate_us,
+            len(encoded.packets(False, False)), len(encoded.packets(False, True))))
+    # whole transfers, where every packet saved is also a packet that cannot be lost
+    messages = [payloads[2][1]] * 10
+    print("%16s %10s %16s %14s" % ("compression", "datagrams", "retransmitted", "mean ms/msg"))
+    for compress in (False, True):
+        sender_sock, receiver_sock = loopback_pair()
+        counted = LossySocket(sender_sock, 0.3)
+        sender = ReliableTransport(counted, 3)
+        receiver = ReliableTransport(receiver_sock, 3)
+        if compress:
+            sender.set_compress(receiver_sock.getsockname())
+        latencies = transfer(sender, receiver, messages)
+        print("%16s %10d %16d %14.1f" % ("on" if compress else "off", counted.sent,
+                                         sender.retransmitted,
+                                         sum(latencies) / len(latencies) * 1e3))
+        sender_sock.close()
+        receiver_sock.close()
+
+
+@benchmark
+def files():
+    '''
+    Throughput and peak traced memory of a file transfer, as one message vs streamed
+    '''
+    print("%8s %10s %10s %14s" % ("MB", "path", "MB/s", "peak MB"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for megabytes in (1, 16):
+            source = os.path.join(tmp, "source")
+            with open(source, "wb") as f:
+                f.write(random.Random(megabytes).randbytes(megabytes << 20))
+            for streamed in (False, True):
+                sender_sock, receiver_sock = loopback_pair()
+                sender = ReliableTransport(sender_sock, 8)
+                # a file as one message is beyond the default max_message
+                receiver = ReliableTransport(receiver_sock, 8, max_message=2 * megabytes << 20)
+                destination = os.path.join(tmp, "destination")
+                receiver.on_stream = lambda address, header, length, digest: \
+                    FileSink(destination, length)
+                header = util.make_message(util.SEND_FILE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                           "1 client1 source")
+                tracemalloc.start()
+                start = time.time()
+                if streamed:
+                    sender.send_stream((receiver_sock.getsockname(),), header, map_file(source))
+                else:
+                    with open(source, "rb") as f:
+                        sender.send(receiver_sock.getsockname(), header.encode() + b" " + f.read())
+                while sender.busy():
+                    timeouts = [t for t in (sender.next_timeout(), receiver.next_timeout())
+                                if t is not None]
+                    ready, _, _ = select.select([sender_sock, receiver_sock], [], [],
+                                                min(timeouts) if timeouts else None)
+                    for sock, transport in ((receiver_sock, receiver), (sender_sock, sender)):
+                        if sock in ready:
+                            data, address = sock.recvfrom(65535)
+                            message = transport.handle_packet(data, address)
+                            if message is not None and not streamed:
+                                with open(destination, "wb") as f:
+                                    f.write(message[len(header) + 1:])
+                    sender.tick()
+                    receiver.tick()
+                elapsed = time.time() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                assert os.path.getsize(destination) == megabytes << 20
+                print("%8d %10s %10.1f %14.2f" % (megabytes, "stream" if streamed else "message",
+                                                 megabytes / elapsed, peak / (1 << 20)))
+                sender_sock.close()
+                receiver_sock.close()
+
+
+@benchmark
+def filecache():
+    '''
+    Datagrams a client sends for a file the server never saw, has cached, or got half of
+    '''
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        server = Server("127.0.0.1", 0, 8, idle_timeout=0, spool_dir=tmp, file_cache=64 << 20)
+        server.events = EventLog(devnull)
+        server_address = server.sock.getsockname()
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client_sock.bind(("127.0.0.1", 0))
+        files = []
+        for i in range(2):
+            path = os.path.join(tmp, "file%d" % i)
+            with open(path, "wb") as f:
+                f.write(random.Random(i).randbytes(4 << 20))
+            files.append(map_file(path))
+        estimates = {} # the round trip times, kept from one send to the next as a client would
+
+        def run(contents, message, limit=None):
+            # sends one message or file, the whole of it or its first limit datagrams
+            counted = LossySocket(client_sock, 0.0)
+            client = ReliableTransport(counted, 8)
+            client.rtt = estimates
+            if contents is None:
+                client.send(server_address, message)
+            else:
+                client.send_stream((server_address,), message, contents, file_digest(contents))
+            start = time.time()
+            while client.busy() and (limit is None or counted.sent < limit):
+                timeouts = [t for t in (server.next_timeout(), client.next_timeout())
+                            if t is not None]
+                ready, _, _ = select.select([server.sock, client_sock], [], [],
+                                            min(timeouts) if timeouts else None)
+                if server.sock in ready:
+                    for msg, length, address in server.io.drain():
+                        server.handle_datagram(msg, address, length)
+                if client_sock in ready:
+                    data, address = client_sock.recvfrom(65535)
+                    client.handle_packet(data, address)
+                server.tick()
+                server.io.flush()
+                client.tick()
+            # let the server take in what is still on its way, drop the replies
+            while select.select([server.sock, client_sock], [], [], 0.05)[0]:
+                for msg, length, address in server.io.drain():
+                    server.handle_datagram(msg, address, length)
+                server.io.flush()
+                while select.select([client_sock], [], [], 0)[0]:
+                    client_sock.recv(65535)
+            return counted.sent, client.skipped, time.time() - start
+
+        run(None, util.make_message(util.JOIN_MESSAGE, util.TYPE_ONE_MSG_FORMAT, "client1"))
+        header = util.make_message(util.SEND_FILE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                   "1 nobody file")
+        half = len(files[1]) // util.FRAGMENT_SIZE // 2
+        print("%22s %10s %10s %10s" % ("send", "datagrams", "skipped", "ms"))
+        for name, contents, limit in (("new file", files[0], None),
+                                      ("same file again", files[0], None),
+                                      ("interrupted half way", files[1], half),
+                                      ("resumed", files[1], None)):
+            sent, skipped, elapsed = run(contents, header, limit)
+            server.chunk_cache.flush() # stores run in the background
+            print("%22s %10d %10d %10.1f" % (name, sent, skipped, elapsed * 1e3))
+        print(' '.join("%s=%d" % item for item in server.file_stats().items()))
+        client_sock.close()
+        server.sock.close()
+        server.close()
+
+
+@benchmark
+def offline():
+    '''
+    Append and drain rate of the offline queue, and memory held per queued message
+    '''
+    message = util.make_message(util.FORWARD_MESSAGE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                "1 sender " + "x" * 80).encode()
+    print("%10s %12s %14s %14s %14s %12s" % ("queued", "appends/s", "appends/sync",
+                                              "drained/s", "bytes/msg", "on disk MB"))
+    for count in (10000, 100000):
+        with tempfile.TemporaryDirectory() as tmp:
+            tracemalloc.start()
+            queue = OfflineQueue(tmp)
+            recipients = ["user%d" % i for i in range(100)]
+            before = tracemalloc.get_traced_memory()[0]
+            start = time.time()
+            for i in range(count):
+                queue.append(recipients[i % 100], message)
+                if i % 256 == 0:
+                    queue.sync() # the server syncs from its loop
+            queue.sync(force=True)
+            appending = time.time() - start
+            held = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            on_disk = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+            stats = queue.stats()
+            start = time.time()
+            drained = 0
+            for name in recipients:
+                while queue.pending(name):
+                    messages = queue.read(name, DRAIN_BATCH)
+                    queue.ack(name, len(messages)) # as soon as sent, no network here
+                    drained += len(messages)
+            queue.sync(force=True)
+            draining = time.time() - start
+            assert drained == count and queue.stats()["queued"] == 0
+            queue.close()
+            print("%10d %12.0f %14.1f %14.0f %14.1f %12.1f" % (
+                count, count / appending, stats["appends_per_sync"], count / draining,
+                held / count, on_disk / (1 << 20)))
+
+
+@benchmark
+def history():
+    '''
+    History lookups by bisection vs a scan of the log, as the history grows
+    '''
+    print("%10s %12s %12s %12s %14s %14s" % ("records", "appends/s", "index B/rec",
+                                              "last-20 us", "since us", "scan since us"))
+    for count in (10000, 100000, 1000000):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = HistoryStore(tmp)
+            recipients = ["user%d" % i for i in range(100)]
+            body = "x" * 60
+            start = time.time()
+            for i in range(count):
+                store.append(recipients[(i + 1) % 100], [recipients[i % 100]], body, 1.0 + i)
+            appending = time.time() - start
+            middle = 1.0 + count - 500 # a catch-up of the last 5 per recipient
+
+            def scan():
+                # what a log without an index does: look at every record (user0 only
+                # hears from user1)
+                return [number for number in range(store.first, store.first + len(store.times))
+                        if store.times[number - store.first] > middle
+                        and store.read(number)[1] == "user1"]
+
+            last = ns_per_op(lambda: [store.read(n) for n in store.last("user0", 20)], 200)
+            since = ns_per_op(lambda: [store.read(n) for n in store.since("user0", middle)], 200)
+            scanning = ns_per_op(scan, max(1, 200000 // count))
+            print("%10d %12.0f %12.1f %12.1f %14.1f %14.1f" % (
+                count, count / appending, store.stats()["index_bytes"] / count,
+                last / 1000, since / 1000, scanning / 1000))
+            store.close()
+
+
+def pump(clients, shared, done, timeout=10):
+    '''
+    Runs the loop of embedded clients registered on the shared selector until done()
+    or timeout seconds passed
+    '''
+    deadline = time.time() + timeout
+    while not done() and time.time() < deadline:
+        timeouts = [t for t in (client.tick() for client in clients) if t is not None]
+        for key, _ in shared.select(min(timeouts + [0.05])):
+            key.data.handle_readable()
+
+
+def start_server(*args):
+    '''
+    Runs server_1.py on a free loopback port, returns the process and the port
+    '''
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__) or ".",
+                                                            "server_1.py"),
+                               "-a", "127.0.0.1", "-p", str(port), "-w", "8",
+                               "--max-clients=1000"] + list(args), stdout=subprocess.DEVNULL)
+    time.sleep(0.5)
+    return server, port
+
+
+@benchmark
+def clientloop():
+    '''
+    Embedded clients trading messages through a server, a receive thread each vs one selector
+    '''
+    server, port = start_server()
+    rounds = 20
+    print("%8s %10s %10s %12s %10s" % ("clients", "loop", "msgs/s", "cpu us/msg", "+threads"))
+    try:
+        for count in (10, 100):
+            for engine in ("threads", "selector"):
+                lines = [] # list.append is safe from every receive thread
+                baseline = threading.active_count()
+                clients = [Client("%s%d_%d" % (engine, count, i), "127.0.0.1", port, 8,
+                                  heartbeat=0, output=lines.append) for i in range(count)]
+                shared = selectors.DefaultSelector()
+                for client in clients:
+                    if engine == "threads":
+                        threading.Thread(target=client.receive_handler, daemon=True).start()
+                    else:
+                        client.selector(shared)
+                    client.join()
+
+                def wait(done):
+                    # until done() or 10s passed, with the clients' loop running
+                    if engine == "selector":
+                        pump(clients, shared, done)
+                        return
+                    deadline = time.time() + 10
+                    while not done() and time.time() < deadline:
+                        time.sleep(0.001)
+
+                wait(lambda: not any(client.transport.busy() for client in clients))
+                threads = threading.active_count() - baseline
+                start, cpu = time.time(), time.process_time()
+                for _ in range(rounds):
+                    for i, client in enumerate(clients):
+                        client.handle_input("msg 1 %s hello" % clients[(i + 1) % count].name)
+                total = rounds * count
+                wait(lambda: len(lines) >= total)
+                elapsed, cpu = time.time() - start, time.process_time() - cpu
+                print("%8d %10s %10.0f %12.1f %10d" % (count, engine, len(lines) / elapsed,
+                                                       cpu / max(1, len(lines)) * 1e6, threads))
+                for client in clients:
+                    client.handle_input("quit")
+                wait(lambda: not any(client.transport.busy() for client in clients))
+                if engine == "selector": # the receive threads stay blocked, daemons
+                    for client in clients:
+                        client.close()
+                shared.close()
+    finally:
+        server.kill()
+        server.wait()
+
+
+@benchmark
+def workers():
+    '''
+    Directory lookups of a worker, through the coordinator vs its own copy, and
+    forwarded messages per second for 1, 2 and 4 workers
+    '''
+    from multiprocessing import get_context
+    from multiprocessing.managers import SyncManager
+    from sharding import SharedDirectory, SharedSessionRegistry
+    manager = SyncManager()
+    manager.start()
+    try:
+        shared = SharedDirectory(manager, get_context("fork"))
+        registry = SharedSessionRegistry(shared, 0)
+        addresses = make_addresses(1000)
+        for i, address in enumerate(addresses):
+            registry.insert("user%d" % i, address)
+        other = SharedSessionRegistry(shared, 1) # sees the joins through the log
+        other.address_of("user0")
+        print("%20s %20s" % ("coordinator ns/op", "copy ns/op"))
+        print("%20.0f %20.0f" % (ns_per_op(lambda: shared.directory.get("user500"), 2000),
+                                 ns_per_op(lambda: other.address_of("user500"), 200000)))
+    finally:
+        manager.shutdown()
+    count, rounds = 100, 20
+    print("%8s %8s %10s %12s" % ("workers", "clients", "msgs/s", "delivered"))
+    for processes in (1, 2, 4):
+        server, port = start_server("--workers=%d" % processes)
+        try:
+            lines = []
+            clients = [Client("w%d_%d" % (processes, i), "127.0.0.1", port, 8, heartbeat=0,
+                              output=lines.append) for i in range(count)]
+            shared = selectors.DefaultSelector()
+            for client in clients:
+                client.selector(shared)
+                client.join()
+            pump(clients, shared, lambda: not any(client.transport.busy() for client in clients))
+            total = rounds * count
+            pick = random.Random(1)
+            start = time.time()
+            for _ in range(rounds):
+                for client in clients:
+                    client.handle_input("msg 1 %s hello" % pick.choice(clients).name)
+            pump(clients, shared, lambda: len(lines) >= total)
+            elapsed = time.time() - start
+            print("%8d %8d %10.0f %12s" % (processes, count, len(lines) / elapsed,
+                                           "%d/%d" % (len(lines), total)))
+            for client in clients:
+                client.handle_input("quit")
+            pump(clients, shared, lambda: not any(client.transport.busy() for client in clients))
+            for client in clients:
+                client.close()
+            shared.close()
+        finally:
+            server.send_signal(2)
+            server.wait()
+
+
+@benchmark
+def fanout():
+    '''
+    CPU per forwarded message, one send() per recipient vs one send_many()
+    '''
+    print("%10s %8s %20s %20s" % ("recipients", "bytes", "per-recipient us/msg", "send_many us/msg"))
+    for recipients in (1, 10, 100, 500):
+        for size in (100, 4000):
+            addresses = make_addresses(recipients)
+            message = util.make_message(util.FORWARD_MESSAGE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                        "1 sender " + "x" * size)
+
+            def per_recipient():
+                transport = ReliableTransport(NullSocket(), 3)
+                for address in addresses:
+                    transport.send(address, message)
+
+            def shared():
+                transport = ReliableTransport(NullSocket(), 3)
+                transport.send_many(addresses, message)
+
+            number = max(3, 2000 // recipients)
+            print("%10d %8d %20.1f %20.1f" % (recipients, size,
+                                               ns_per_op(per_recipient, number) / 1000,
+                                               ns_per_op(shared, number) / 1000))
+
+
+@benchmark
+def queues():
+    '''
+    Sender memory while 100 recipients never ack a stream of forwards, per queue policy
+    '''
+    addresses = make_addresses(100)
+    message = util.make_message(util.FORWARD_MESSAGE_MESSAGE, util.TYPE_FOUR_MSG_FORMAT,
+                                "1 sender " + "x" * 200)
+    print("%12s %10s %12s %10s %10s %10s" % ("policy", "messages", "retained KB", "queued",
+                                             "deepest", "dropped"))
+    for policy, limit in (("unbounded", 10 ** 9), ("drop-oldest", 64), ("drop-newest", 64),
+                          ("disconnect", 64)):
+        for count in (1000, 5000):
+            tracemalloc.start()
+            transport = ReliableTransport(NullSocket(), 3, max_queued=limit,
+                                          max_queued_bytes=limit * 1024,
+                                          overflow="drop-oldest" if policy == "unbounded" else policy)
+            for _ in range(count):
+                transport.send_many(addresses, message)
+            retained = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            stats = transport.queue_stats()
+            print("%12s %10d %12.0f %10d %10d %10d" % (policy, count, retained / 1024,
+                                                       stats["messages"], stats["deepest"],
+                                                       stats["dropped"]))
+
+
+@benchmark
+def userslist():
+    '''
+    Cost of answering request_users_list, sort and serialise every time vs cached response
+    '''
+    print("%10s %18s %18s" % ("users", "rebuild us/req", "cached us/req"))
+    for count in (10, 1000, 10000):
+        server = Server("127.0.0.1", 0, 3)
+        server.transport.sock = NullSocket()
+        for i, address in enumerate(make_addresses(count)):
+            server.active_clients.insert("user%d" % i, address)
+
+        def rebuild():
+            return encode(util.make_message(util.RESPONSE_USERS_LIST_MESSAGE,
+                                            util.TYPE_THREE_MSG_FORMAT,
+                                            ' '.join(sorted(server.active_clients.usernames()))))
+
+        number = max(5, 20000 // count)
+        print("%10d %18.1f %18.1f" % (count, ns_per_op(rebuild, number) / 1000,
+                                       ns_per_op(server.users_list_response, 20000) / 1000))
+        server.sock.close()
+
+
+@benchmark
+def wireformat():
+    '''
+    Bytes per packet and build/parse cost, text framing vs binary framing
+    '''
+    print("%8s %8s %12s %12s %12s %12s" % ("body", "format", "bytes/pkt", "build ns", "parse ns",
+                                          "header B"))
+    for size in (0, 20, 200, util.FRAGMENT_SIZE):
+        payload = b"x" * size
+        for name, make, parse in (
+                ("text", util.make_packet_bytes, util.parse_packet_bytes),
+                ("binary", util.make_binary_packet, util.parse_binary_packet)):
+            packet = make(util.DATA_PACKET_TYPE, 12345678, payload)
+            build = ns_per_op(lambda: make(util.DATA_PACKET_TYPE, 12345678, payload), 100000)
+            parsed = ns_per_op(lambda: parse(packet), 100000)
+            print("%8d %8s %12d %12.0f %12.0f %12d" % (size, name, len(packet), build, parsed,
+                                                      len(packet) - size))
+
+
+@benchmark
+def checksum():
+    '''
+    Receive-side checksum check, decode + rsplit + re-encode vs in place on the bytes
+    '''
+    def validate_str(raw):
+        # the original util.validate_checksum, fed with the decoded datagram
+        try:
+            msg, checksum = raw.decode().rsplit('|', 1)
+            msg += '|'
+            return util.generate_checksum(msg.encode()) == checksum
+        except BaseException:
+            return False
+
+    print("%8s %16s %16s" % ("body", "str ns/pkt", "bytes ns/pkt"))
+    for size in (20, 200, util.FRAGMENT_SIZE):
+        packet = util.make_packet_bytes(util.DATA_PACKET_TYPE, 12345678, b"x" * size)
+        print("%8d %16.0f %16.0f" % (size, ns_per_op(lambda: validate_str(packet), 100000),
+                                     ns_per_op(lambda: util.validate_checksum_bytes(packet), 100000)))
+
+
+@benchmark
+def parser():
+    '''
+    Parsing a reassembled send_message, decode + split per field vs one pass over the bytes
+    '''
+    def parse_str(payload):
+        # the original path: the transport decoded the message and the server
+        # split() it again for every field it looked at
+        data = payload.decode()
+        command = data.split()[0]
+        count = int(data.split()[2])
+        words = data.split()[3:]
+        return command, words[:count], ' '.join(words[count:])
+
+    def parse_bytes(payload):
+        message = parse_message(payload)
+        return message.command, message.names(), message.body()
+
+    print("%10s %8s %16s %16s" % ("recipients", "body", "str ns/msg", "bytes ns/msg"))
+    for recipients, size in ((1, 20), (10, 200), (util.MAX_NUM_CLIENTS, 1000)):
+        names = ["client%d" % i for i in range(recipients)]
+        fields = "%d %s %s" % (recipients, ' '.join(names), ' '.join(["word"] * (size // 5)))
+        payload = bytearray(util.make_message(util.SEND_MESSAGE_MESSAGE,
+                                              util.TYPE_FOUR_MSG_FORMAT, fields).encode())
+        assert parse_str(payload) == parse_bytes(payload)
+        print("%10d %8d %16.0f %16.0f" % (recipients, size,
+                                          ns_per_op(lambda: parse_str(payload), 50000),
+                                          ns_per_op(lambda: parse_bytes(payload), 50000)))
+
+@benchmark
+def eventlog():
+    '''
+    Cost of one output line in the server loop, print() vs EventLog.log()
+    '''
+    lines = ["msg: client%d" % (i % 10) for i in range(20000)]
+    with tempfile.TemporaryDirectory() as tmp:
+        # line buffered like a terminal or a pipe read by another process
+        with open(os.path.join(tmp, "print"), "w", buffering=1) as out:
+            per_print = ns_per_op(lambda: [print(line, file=out) for line in lines], 1) / len(lines)
+        with open(os.path.join(tmp, "eventlog"), "w", buffering=1) as out:
+            events = EventLog(out)
+            per_log = ns_per_op(lambda: [events.log(line) for line in lines], 1) / len(lines)
+            events.close()
+            stats = events.stats()
+        with open(os.path.join(tmp, "print")) as a, open(os.path.join(tmp, "eventlog")) as b:
+            assert a.read() == b.read()
+    print("%16s %16s %16s" % ("print ns/line", "log ns/line", "lines/batch"))
+    print("%16.0f %16.0f %16.1f" % (per_print, per_log, stats["lines_per_batch"]))
+
+
+if __name__ == "__main__":
+    NAMES = sys.argv[1:] or list(BENCHMARKS)
+    for name in NAMES:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: %s (available: %s)" % (name, ", ".join(BENCHMARKS)))
+            sys.exit(1)
+        print("== %s: %s" % (name, BENCHMARKS[name].__doc__.strip()))
+        BENCHMARKS[name]()
@@ -0,0 +1,89 @@
+'''
+This module batches the datagram I/O of the Server loop.
+
+Each wakeup drains every datagram that is ready into a ring of preallocated
+bytearray slots with recvfrom_into(), so receiving allocates no bytes object per
+datagram. Outbound datagrams are queued by sendto() and written together by
+flush() once per loop turn.
+'''
+import select
+import util
+
+
+class BulkSocket:
+    '''
+    Wraps a UDP socket for batched, allocation-free receives and batched sends.
+    It can be handed to ReliableTransport in place of the socket.
+    '''
+    def __init__(self, sock, slots=64, slot_size=util.CHUNK_SIZE):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.ring = [bytearray(slot_size) for _ in range(slots)]
+        self.outbound = [] # (datagram, address) waiting for flush()
+        # counters, see stats()
+        self.syscalls = 0
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0 # sends refused by a full socket buffer
+
+    def wait(self, timeout):
+        '''
+        Blocks until a datagram is ready or timeout seconds passed (None waits forever)
+        '''
+        self.syscalls += 1
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(ready)
+
+    def drain(self):
+        '''
+        Receives every datagram that is ready, up to one per slot.
+        Returns a list of (slot, length, address); a slot is reused by the next drain().
+        '''
+        batch = []
+        recvfrom_into = self.sock.recvfrom_into
+        for slot in self.ring:
+            self.syscalls += 1
+            try:
+                length, address = recvfrom_into(slot)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionError: # ICMP error for an earlier send, nothing to read
+                continue
+            batch.append((slot, length, address))
+        self.received += len(batch)
+        return batch
+
+    def sendto(self, datagram, address):
+        '''
+        Queues a datagram, written by the next flush()
+        '''
+        self.outbound.append((datagram, address))
+
+    def flush(self):
+        '''
+        Writes every queued datagram
+        '''
+        if not self.outbound:
+            return
+        sendto = self.sock.sendto
+        for datagram, address in self.outbound:
+            self.syscalls += 1
+            try:
+                sendto(datagram, address)
+                self.sent += 1
+            except (BlockingIOError, ConnectionError):
+                self.dropped += 1 # the transport retransmits it
+        self.outbound.clear()
+
+    def stats(self):
+        '''
+        Returns the I/O counters and the syscalls spent per datagram
+        '''
+        datagrams = self.received + self.sent
+        return {
+            "syscalls": self.syscalls,
+            "received": self.received,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "syscalls_per_datagram": self.syscalls / datagrams if datagrams else 0.0,
+        }
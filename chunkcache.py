@@ -0,0 +1,277 @@
+'''
+This module keeps the files the server relayed, cut into content-addressed chunks.
+
+Every chunk of CACHE_CHUNK bytes is stored once, in a file named after its SHA-256
+hash, however many files contain it. A manifest per file digest lists the hashes of
+its chunks, so a file whose digest is known again is rebuilt from the chunks instead
+of being sent again. The chunks are evicted least recently used first once they take
+more than `capacity` bytes; a manifest that lost a chunk is forgotten when it is
+next looked up. The manifests only live in memory, so the chunks are kept in a
+temporary directory of their own that close() removes.
+
+Transfers that stopped half way are kept too, as their FileSink, for at most
+MAX_PARTIALS digests: the same user sending the same contents again resumes where
+they stopped. Only the user who sent the beginning may resume it, so that nobody
+can plant contents under the digest of another user's file; the digest of the whole
+file is checked once it is complete all the same.
+
+A file is served from the cache to whoever presents its digest: the digest stands
+for the contents, as in any content-addressed store, and a sender that knows it is
+not asked to prove it holds the contents. That is a deliberate choice: the file only
+goes to the recipients the sender names, and learning the SHA-256 digest of a file
+in practice takes having the file. A deployment where digests may leak should not
+enable the cache.
+
+Storing a relayed file, hashing and writing all of its chunks, runs on a thread of
+its own so that it never holds up the event loop; the lock guards the tables the
+two share. So does rebuilding a known file into a spool file: open() returns None
+until it is done, the server leaves the start packet of the transfer unacked
+meanwhile, and the sender's next retransmission of it gets the rebuilt file.
+'''
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import util
+from filetransfer import FileSink
+
+CACHE_CHUNK = util.FRAGMENT_SIZE * 48 # bytes per chunk, a whole number of fragments
+CACHE_CAPACITY = 256 << 20 # default bytes of chunks kept on disk
+MAX_MANIFESTS = 4096
+MAX_PARTIALS = 8
+
+
+class ChunkCache:
+    '''
+    Bounded on-disk cache of file contents, keyed by their digest.
+    '''
+    def __init__(self, capacity=CACHE_CAPACITY, parent=None):
+        self.capacity = capacity
+        # in parent, or the temporary directory
+        self.directory = tempfile.mkdtemp(prefix="chunks-", dir=parent)
+        self.chunks = OrderedDict() # chunk hash : size, least recently used first
+        self.size = 0 # bytes of chunks on disk
+        self.manifests = OrderedDict() # file digest : (length, [chunk hash])
+        # file digest : (FileSink of a stopped transfer, username that sent it)
+        self.partials = OrderedDict()
+        self.lock = threading.Lock()
+        # (digest, length, username) : [FileSink, True once rebuilt or False if that
+        # failed, None meanwhile, True if dropped meanwhile], for at most MAX_PARTIALS
+        self.restores = OrderedDict()
+        self.stores = queue.Queue() # (function, arguments) for the storing thread
+        self.storer = None # started on first store() or restore
+        # counters, see stats()
+        self.hits = 0
+        self.misses = 0
+        self.resumed = 0
+        self.bytes_saved = 0 # bytes the senders did not have to send again
+        self.evictions = 0
+
+    def open(self, digest, length, spool_dir=None, owner=None):
+        '''
+        Returns a hashed FileSink for a transfer of the given digest and length from
+        the user owner, holding what the cache already has of it: all of it, the
+        fragments a stopped transfer of owner received, or nothing. Returns None
+        while a known file is being rebuilt: ask again later.
+        '''
+        partial, sender = self.partials.get(digest, (None, None))
+        if partial is not None and sender == owner:
+            del self.partials[digest]
+            if partial.length == length:
+                self.resumed += 1
+                self.bytes_saved += min(partial.prefix() * partial.size, length)
+                return partial
+            partial.discard()
+        key = (digest, length, owner)
+        with self.lock:
+            entry = self.restores.get(key)
+            if entry is not None:
+                if entry[1] is None:
+                    return None # still being rebuilt
+                del self.restores[key]
+            known = entry is None and self._known(digest, length)
+        if entry is not None:
+            if entry[1]:
+                self.hits += 1
+                self.bytes_saved += length
+            else:
+                self.misses += 1
+            return entry[0]
+        sink = FileSink.spool(length, spool_dir, hashed=True)
+        if not known:
+            self.misses += 1
+            return sink
+        entry = [sink, None, False]
+        with self.lock:
+            self.restores[key] = entry
+            while len(self.restores) > MAX_PARTIALS:
+                dropped = self.restores.popitem(last=False)[1]
+                if dropped[1] is None:
+                    dropped[2] = True # the storing thread discards it
+                else:
+                    dropped[0].discard()
+        self._submit(self._restore, entry, digest, length)
+        return None
+
+    def _known(self, digest, length):
+        # True if all the chunks of the file are there, the lock is held
+        manifest = self.manifests.get(digest)
+        if manifest is None or manifest[0] != length:
+            return False
+        if any(chunk not in self.chunks for chunk in manifest[1]):
+            del self.manifests[digest] # lost a chunk to eviction
+            return False
+        return True
+
+    def _restore(self, entry, digest, length):
+        # rebuilds a file into the sink of entry, on the storing thread
+        try:
+            restored = self.restore(digest, length, entry[0])
+        except OSError:
+            restored = False
+        with self.lock:
+            if entry[2]:
+                entry[0].discard()
+            else:
+                entry[1] = restored
+
+    def restore(self, digest, length, sink):
+        '''
+        Writes the chunks of a known file to sink, returns False if some are missing.
+        Only the storing thread evicts chunks, so on that thread the copy needs no lock.
+        '''
+        with self.lock:
+            if not self._known(digest, length):
+                return False
+            hashes = self.manifests[digest][1]
+            self.manifests.move_to_end(digest)
+            for chunk in hashes:
+                self.chunks.move_to_end(chunk)
+        fragments = CACHE_CHUNK // sink.size
+        for i, chunk in enumerate(hashes):
+            with open(os.path.join(self.directory, chunk), "rb") as f:
+                data = f.read()
+            for offset in range(0, len(data), sink.size):
+                sink.add(i * fragments + offset // sink.size, data[offset:offset + sink.size])
+        if length == 0:
+            sink.add(0, b"")
+        return True
+
+    def store(self, digest, contents):
+        '''
+        Adds the contents of a complete file, a bytes-like object that must not change,
+        unless it is larger than the whole cache. The chunks are written in the
+        background, see flush().
+        '''
+        if len(contents) > self.capacity:
+            return
+        with self.lock:
+            if digest in self.manifests:
+                return
+        self._submit(self._store, digest, contents)
+
+    def _submit(self, function, *args):
+        # runs function(*args) on the storing thread
+        if self.storer is None:
+            self.storer = threading.Thread(target=self.run_stores, daemon=True)
+            self.storer.start()
+        self.stores.put((function, args))
+
+    def flush(self):
+        '''
+        Waits until the files passed to store() are in the cache, and the files open()
+        rebuilds are rebuilt
+        '''
+        if self.storer is not None:
+            self.stores.join()
+
+    def run_stores(self):
+        # body of the storing thread, until close() puts None
+        while True:
+            item = self.stores.get()
+            try:
+                if item is None:
+                    return
+                function, args = item
+                function(*args)
+            except OSError:
+                pass # the chunks written so far are evicted in time
+            finally:
+                self.stores.task_done()
+
+    def _store(self, digest, contents):
+        hashes = []
+        with memoryview(contents) as view:
+            for offset in range(0, len(view), CACHE_CHUNK):
+                data = view[offset:offset + CACHE_CHUNK]
+                chunk = hashlib.sha256(data).hexdigest()
+                with self.lock:
+                    known = chunk in self.chunks
+                    if known:
+                        self.chunks.move_to_end(chunk)
+                if not known:
+                    # only this thread adds chunks, so nobody else writes the file
+                    with open(os.path.join(self.directory, chunk), "wb") as f:
+                        f.write(data)
+                    with self.lock:
+                        self.chunks[chunk] = len(data)
+                        self.size += len(data)
+                hashes.append(chunk)
+        with self.lock:
+            self.manifests[digest] = (len(contents), hashes)
+            while len(self.manifests) > MAX_MANIFESTS:
+                self.manifests.popitem(last=False)
+            self.evict(hashes)
+
+    def evict(self, keep=()):
+        # removes the least recently used chunks until they fit the capacity, the
+        # lock is held
+        keep = set(keep)
+        for chunk in list(self.chunks):
+            if self.size <= self.capacity:
+                break
+            if chunk in keep:
+                continue
+            self.size -= self.chunks.pop(chunk)
+            os.unlink(os.path.join(self.directory, chunk))
+            self.evictions += 1
+
+    def keep_partial(self, digest, sink, owner=None):
+        '''
+        Keeps the sink of a transfer the user owner stopped half way, to be resumed by
+        open() for the same user
+        '''
+        previous, _ = self.partials.pop(digest, (None, None))
+        if previous is not None and previous is not sink:
+            previous.discard()
+        self.partials[digest] = (sink, owner)
+        while len(self.partials) > MAX_PARTIALS:
+            self.partials.popitem(last=False)[1][0].discard()
+
+    def stats(self):
+        '''
+        Returns the hit and miss counters and the size of the cache
+        '''
+        return {"hits": self.hits, "misses": self.misses, "resumed": self.resumed,
+                "bytes_saved": self.bytes_saved, "chunks": len(self.chunks),
+                "bytes": self.size, "files": len(self.manifests),
+                "partials": len(self.partials), "evictions": self.evictions}
+
+    def close(self):
+        '''
+        Deletes the chunks, the stopped transfers and the rebuilt files nobody took
+        '''
+        if self.storer is not None:
+            self.stores.put(None)
+            self.storer.join()
+            self.storer = None
+        for sink, _ in self.partials.values():
+            sink.discard()
+        self.partials.clear()
+        for entry in self.restores.values():
+            entry[0].discard()
+        self.restores.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
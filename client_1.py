@@ -2,12 +2,19 @@
 This module defines the behaviour of a client in your Chat Application
 '''
 import sys
+import errno
 import getopt
 import socket
 import random
+import time
+import select
+import selectors
 from threading import Thread
 import os
 import util
+from parsing import parse_message, unbatch, HISTORY_PREFIX
+from transport import ReliableTransport
+from filetransfer import FileSink, file_digest, map_file
 
 
 '''
@@ -21,16 +28,92 @@ class Client:
     '''
     This is the main Client Class. 
     '''
-    def __init__(self, username, dest, port, window_size):
+    def __init__(self, username, dest, port, window_size, binary=False,
+                 heartbeat=util.HEARTBEAT_TIMEOUTS * util.TIME_OUT, delayed_acks=False,
+                 coalesce=False, compress=False, output=print):
         self.server_addr = dest
         self.server_port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(None)
-        self.sock.bind(('', random.randint(10000, 40000)))
+        while True:
+            # many clients may live in one process, e.g. a load tool: draw a port again
+            # if another one took it
+            try:
+                self.sock.bind(('', random.randint(10000, 40000)))
+                break
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE:
+                    raise
         self.name = username
 
         # additional_vars
         self.should_close_connection = False
+        self.quitting = False # the disconnect message was sent
+        # every line for the user goes through output, so that a program embedding the
+        # client can collect them
+        self.output = output
+        self._selector = None # of the single-threaded loop, see selector()
+        self.shared_selector = False
+        # the receive thread also waits on wakeup, so that a message sent from the main
+        # thread has its retransmission timer taken into account at once, see wake()
+        self.wakeup, self.waker = None, None
+        # acks come back from the resolved address, so key the transport by it
+        self.server = (socket.gethostbyname(self.server_addr), self.server_port)
+        # only what queues up behind the connection in flight is coalesced: the thread
+        # that sends would not be there to send a message held back for company
+        self.transport = ReliableTransport(self.sock, window_size, delayed_ack=delayed_acks,
+                                           coalesce=coalesce, coalesce_delay=0)
+        # binary framing is asked for at join and used once the server answers in it
+        self.binary = binary
+        self.transport.accept_binary = binary
+        # compression is offered at join; the server compresses to us only if we offer
+        # it, and understands compressed messages itself
+        self.compress = compress
+        if compress:
+            self.transport.set_compress(self.server)
+        # received files are written to disk as their packets arrive
+        self.transport.on_stream = self.handle_stream
+        # nobody but the server has anything to send us
+        self.transport.is_peer = lambda address: address == self.server
+        self.incoming_file = None # FileSink of the file being received
+        # keepalives stop the server from dropping us while the user is quiet
+        self.heartbeat = heartbeat or None
+        self.next_heartbeat = time.time() + (heartbeat or 0)
+
+    def send(self, message):
+        '''
+        Reliably sends a message to the server
+        '''
+        self.transport.send(self.server, message)
+        self.wake()
+
+    def wake(self):
+        '''
+        Has the receive thread compute its timeout again, after a send
+        '''
+        if self.waker is not None:
+            try:
+                self.waker.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass # woken up already, or gone
+
+    def wait_until_delivered(self):
+        '''
+        Blocks until every message sent so far was acknowledged or given up on
+        '''
+        while self.transport.busy() and not self.should_close_connection:
+            time.sleep(util.TIME_OUT / 50)
+
+    def join(self):
+        '''
+        Sends the join message, with the capabilities asked for
+        '''
+        join = self.name
+        if self.binary:
+            join += " " + util.BINARY_CAPABILITY
+        if self.compress:
+            join += " " + util.COMPRESS_CAPABILITY
+        self.send(util.make_message(util.JOIN_MESSAGE,util.TYPE_ONE_MSG_FORMAT,join))
 
     def start(self):
         '''
@@ -40,102 +123,331 @@ class Client:
         Waits for userinput and then process it
         '''
         # implementation
-        message = util.make_message(util.JOIN_MESSAGE,util.TYPE_ONE_MSG_FORMAT,self.name)
-        packet = util.make_packet(util.DATA_PACKET_TYPE,0,message)
-        self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
+        self.join()
 
         # wait for user input
         while True:
             if self.should_close_connection:
                 break
             user_input = input()
+            self.handle_input(user_input)
+            if self.quitting:
+                self.wait_until_delivered()
+                self.output("quitting")
+                return
 
-            if user_input == "list":
-                message = util.make_message(util.REQUEST_USERS_LIST_MESSAGE,
-                                            util.TYPE_TWO_MSG_FORMAT)
-                packet = util.make_packet(util.DATA_PACKET_TYPE,0,message)
-                self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-            elif user_input.startswith('msg'):
-                user_input = user_input.split()
+    def handle_input(self, user_input):
+        '''
+        Acts on one line of user input. After quit, the disconnect message is on its way
+        and self.quitting is set.
+        '''
+        if user_input == "list":
+            self.send(util.make_message(util.REQUEST_USERS_LIST_MESSAGE,
+                                        util.TYPE_TWO_MSG_FORMAT))
+        elif user_input.startswith('msg'):
+            user_input = user_input.split()
 
-                if len(user_input) < 4: # msg <num_users> usernames.. message
-                    print("Incorrect user input format")
-                    continue
-                try:
-                    num_users = int(user_input[1])
-                except ValueError:
-                    print("Incorrect user input format")
-                    continue
-                if len(user_input) < 2 + num_users:
-                    print("Incorrect user input format")
-                    continue
-                users = ' '.join(user_input[2 : 2+num_users])
-                message = ' '.join(user_input[2+num_users : ])
-                packet = util.make_packet(util.DATA_PACKET_TYPE,0,util.make_message(
-                    util.SEND_MESSAGE_MESSAGE,util.TYPE_FOUR_MSG_FORMAT,
-                    "{} {} {}".format(num_users,users,message)
-                ))
-                self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-            elif user_input == "help":
-                pass
-            elif user_input == "quit":
-                packet = util.make_packet(util.DATA_PACKET_TYPE,0,util.make_message(
-                    util.DISCONNECT_MESSAGE,util.TYPE_ONE_MSG_FORMAT,self.name
-                ))
-                self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-                print("quitting")
+            if len(user_input) < 4: # msg <num_users> usernames.. message
+                self.output("Incorrect user input format")
+                return
+            try:
+                num_users = int(user_input[1])
+            except ValueError:
+                self.output("Incorrect user input format")
+                return
+            if len(user_input) < 2 + num_users:
+                self.output("Incorrect user input format")
+                return
+            users = ' '.join(user_input[2 : 2+num_users])
+            message = ' '.join(user_input[2+num_users : ])
+            self.send(util.make_message(
+                util.SEND_MESSAGE_MESSAGE,util.TYPE_FOUR_MSG_FORMAT,
+                "{} {} {}".format(num_users,users,message)
+            ))
+        elif user_input.startswith('file'):
+            user_input = user_input.split()
+
+            if len(user_input) < 4: # file <num_users> usernames.. filename
+                self.output("Incorrect user input format")
+                return
+            try:
+                num_users = int(user_input[1])
+            except ValueError:
+                self.output("Incorrect user input format")
+                return
+            if len(user_input) != 3 + num_users:
+                self.output("Incorrect user input format")
                 return
+            filename = user_input[2+num_users]
+            try:
+                contents = map_file(filename)
+            except OSError:
+                self.output("No such file: {}".format(filename))
+                return
+            users = ' '.join(user_input[2 : 2+num_users])
+            try:
+                self.transport.send_stream((self.server,), util.make_message(
+                    util.SEND_FILE_MESSAGE,util.TYPE_FOUR_MSG_FORMAT,
+                    "{} {} {}".format(num_users,users,os.path.basename(filename))
+                ), contents, file_digest(contents)) # lets the server skip what it holds
+            except ValueError:
+                # too many or too long names for the start packet
+                self.output("Incorrect user input format")
+                return
+            self.wake()
+        elif user_input.startswith('history'):
+            user_input = user_input.split()
+
+            # history [<num_messages> [username]]
+            if user_input[0] != "history" or len(user_input) > 3:
+                self.output("Incorrect user input format")
+                return
+            if len(user_input) > 1 and not user_input[1].isdigit():
+                self.output("Incorrect user input format")
+                return
+            if len(user_input) == 1:
+                self.send(util.make_message(util.REQUEST_HISTORY_MESSAGE,
+                                            util.TYPE_TWO_MSG_FORMAT))
             else:
-                print("Incorrect user input format")
+                self.send(util.make_message(util.REQUEST_HISTORY_MESSAGE,
+                                            util.TYPE_ONE_MSG_FORMAT,
+                                            ' '.join(user_input[1:])))
+        elif user_input == "help":
+            pass
+        elif user_input == "quit":
+            self.send(util.make_message(
+                util.DISCONNECT_MESSAGE,util.TYPE_ONE_MSG_FORMAT,self.name
+            ))
+            self.quitting = True
+        else:
+            self.output("Incorrect user input format")
+
+    def next_timeout(self):
+        '''
+        Sends a keepalive if one is due, then returns the number of seconds until the
+        next retransmission or keepalive, or None
+        '''
+        timeout = self.transport.next_timeout()
+        if self.heartbeat is None:
+            return timeout
+        now = time.time()
+        if now >= self.next_heartbeat:
+            self.transport.keepalive(self.server)
+            self.next_heartbeat = now + self.heartbeat
+        until = self.next_heartbeat - now
+        return until if timeout is None else min(timeout, until)
+
+    def handle_stream(self, server, header, length, digest):
+        '''
+        Returns the file the contents of a forwarded file are written to, saved as
+        <username>_<filename>, or None to refuse the transfer
+        '''
+        try:
+            parsed = parse_message(header)
+        except ValueError:
+            return None
+        if parsed.command != util.FORWARD_FILE_MESSAGE:
+            return None
+        filename = os.path.basename(parsed.body())
+        if not filename:
+            return None
+        if self.incoming_file is not None:
+            self.incoming_file.close() # abandoned by the server
+        self.incoming_file = FileSink("{}_{}".format(self.name, filename), length)
+        return self.incoming_file
 
     def receive_handler(self):
         '''
         Waits for a message from server and process it accordingly
         '''
         # implementation
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
         while True:
             try:
-                msg, _ = self.sock.recvfrom(util.CHUNK_SIZE)
-                packet_type, seqno, data, checksum = util.parse_packet(msg.decode())
-                
-                if packet_type == util.DATA_PACKET_TYPE:
-                    message = data.split()[0]
-                    if message == util.ERR_SERVER_FULL_MESSAGE:
-                        # print("received ERR_SERVER_FULL_MESSAGE from server")
-                        # close the connection to server and shut down
-                        print("disconnected: server full")
-                        raise SystemExit
-                    elif message == util.ERR_USERNAME_UNAVAILABLE_MESSAGE:
-                        # print("received err username unavailable msg from server")
-                        # close the connection to server and shut down
-                        print("disconnected: username not available")
-                        # raise SystemExit
-                        self.should_close_connection = True
-                        return
-                    elif message == util.RESPONSE_USERS_LIST_MESSAGE:
-                        # print("client received response for users list from server")
-                        # parse the response from server
-                        usernames_list = ' '.join([e for e in data.split()[2:]])
-                        print("list: {}".format(usernames_list))
-                    elif message == util.FORWARD_MESSAGE_MESSAGE:
-                        sender = data.split()[3]
-                        msg = ' '.join(data.split()[4:])
-                        print("msg: {}: {}".format(sender,msg))
-                    else:
+                # wake up for retransmissions and keepalives even when the server is
+                # quiet, and for the timers of what the main thread just sent
+                ready, _, _ = select.select([self.sock, self.wakeup], [], [],
+                                            self.next_timeout())
+                if self.wakeup in ready:
+                    try:
+                        self.wakeup.recv(4096)
+                    except BlockingIOError:
                         pass
-                elif packet_type == util.START_PACKET_TYPE:
-                    pass
-                elif packet_type == util.END_PACKET_TYPE:
-                    pass
-                elif packet_type == util.ACK_PACKET_TYPE:
-                    pass
-                else:
-                    pass
+                if self.sock not in ready:
+                    self.transport.tick()
+                    continue
+                msg, address = self.sock.recvfrom(util.CHUNK_SIZE)
+                data = None
+                if address == self.server: # anybody else's datagrams are dropped
+                    data = self.transport.handle_packet(msg, address)
+                self.transport.tick()
+                if data is None:
+                    continue
+                self.handle_data(data)
+                if self.should_close_connection:
+                    return
             except Exception as e:
                 self.sock.close()
+                self.wakeup.close()
+                self.waker.close()
                 self.should_close_connection = True
                 raise SystemExit
 
+    def handle_data(self, data):
+        '''
+        Processes a complete message from the server. An error from the server sets
+        should_close_connection.
+        '''
+        # a batch packs several messages, see util.make_batch()
+        for part in unbatch(data):
+            parsed = parse_message(part)
+            message = parsed.command
+            if message == util.ERR_SERVER_FULL_MESSAGE:
+                # close the connection to server and shut down
+                self.output("disconnected: server full")
+                self.should_close_connection = True
+                return
+            elif message == util.ERR_USERNAME_UNAVAILABLE_MESSAGE:
+                # close the connection to server and shut down
+                self.output("disconnected: username not available")
+                self.should_close_connection = True
+                return
+            elif message == util.ERR_FILE_FAILED_MESSAGE:
+                # the contents the server got did not match their digest
+                self.output("file: {} failed, send it again".format(' '.join(parsed.names())))
+            elif message == util.ERR_NOT_JOINED_MESSAGE:
+                # the server dropped the session, say after a long silence
+                if not self.quitting:
+                    self.output("disconnected: session expired, joining again")
+                    self.join()
+            elif message == util.RESPONSE_USERS_LIST_MESSAGE:
+                # parse the response from server
+                usernames_list = ' '.join(parsed.names())
+                self.output("list: {}".format(usernames_list))
+            elif message == util.FORWARD_MESSAGE_MESSAGE:
+                sender = parsed.names()[0]
+                msg = parsed.body()
+                self.output("msg: {}: {}".format(sender,msg))
+            elif message == util.FORWARD_FILE_MESSAGE:
+                if self.incoming_file is not None:
+                    self.incoming_file.close()
+                    self.incoming_file = None
+                self.output("file: {}: {}".format(parsed.names()[0], parsed.body()))
+            elif message == util.RESPONSE_HISTORY_MESSAGE:
+                # a page of forward_messages, empty if there was nothing to send
+                entries = [parse_message(entry) for entry in unbatch(part, HISTORY_PREFIX)]
+                if not entries:
+                    self.output("history: no messages")
+                for entry in entries:
+                    self.output("history: {}: {}".format(entry.names()[0], entry.body()))
+
+    def poll(self, timeout=None):
+        '''
+        Waits for packets from the server, for at most timeout seconds (None waits until
+        one arrives) and never past the next retransmission or keepalive, then processes
+        them and the timers that are due. Returns the keys of the other files that are
+        ready, see register().
+        '''
+        until = self.next_timeout()
+        if timeout is not None:
+            until = timeout if until is None else min(until, timeout)
+        events = []
+        for key, _ in self.selector().select(until):
+            if key.fileobj is self.sock:
+                self.handle_readable()
+            else:
+                events.append(key)
+        self.tick()
+        return events
+
+    def handle_readable(self):
+        '''
+        Processes the packets waiting on the non-blocking socket
+        '''
+        while not self.should_close_connection:
+            try:
+                msg, address = self.sock.recvfrom(util.CHUNK_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            if address != self.server:
+                continue # anybody else's datagrams are dropped
+            data = self.transport.handle_packet(msg, address)
+            if data is not None:
+                self.handle_data(data)
+
+    def tick(self):
+        '''
+        Runs the retransmissions and keepalives that are due, then returns the number of
+        seconds until the next ones, or None
+        '''
+        self.transport.tick()
+        return self.next_timeout()
+
+    def selector(self, shared=None):
+        '''
+        Returns the selector the socket is registered on, made on first use unless a
+        shared one is given; the socket becomes non-blocking then. Many clients can
+        share one selector: their socket's key has the client as data, and the owner
+        of the selector calls handle_readable() and tick() instead of poll().
+        '''
+        if self._selector is None:
+            self.sock.setblocking(False)
+            self._selector = shared if shared is not None else selectors.DefaultSelector()
+            self.shared_selector = shared is not None
+            self._selector.register(self.sock, selectors.EVENT_READ, self)
+        return self._selector
+
+    def register(self, fileobj, data=None):
+        '''
+        Has poll() also wait for fileobj to be readable, and return its selector key
+        with the given data when it is
+        '''
+        self.selector().register(fileobj, selectors.EVENT_READ, data)
+
+    def run(self, stdin=None):
+        '''
+        Main loop of the single-threaded client: joins, then multiplexes the socket,
+        the user input read from the stdin file descriptor and the timers in one
+        selector until the user quits or the server turns the client away. The end
+        of the input quits.
+        '''
+        stdin = sys.stdin.fileno() if stdin is None else stdin
+        self.register(stdin)
+        self.join()
+        pending = b""
+        while not self.should_close_connection:
+            if self.quitting and not self.transport.busy():
+                self.output("quitting")
+                break
+            for _ in self.poll():
+                # stdin is the only other file registered
+                data = os.read(stdin, 65536)
+                if not data:
+                    self.selector().unregister(stdin)
+                    if not self.quitting:
+                        self.handle_input("quit")
+                    break
+                lines = (pending + data).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    if self.quitting or self.should_close_connection:
+                        break
+                    self.handle_input(line.decode(errors="replace").rstrip("\r"))
+        self.close()
+
+    def close(self):
+        '''
+        Closes the socket, and the selector unless it is shared
+        '''
+        if self._selector is not None:
+            self._selector.unregister(self.sock)
+            if not self.shared_selector:
+                self._selector.close()
+            self._selector = None
+        self.sock.close()
+
 # Do not change below part of code
 if __name__ == "__main__":
     def helper():
@@ -147,10 +459,20 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW_SIZE | --window=WINDOW_SIZE The window_size, defaults to 3")
+        print("--binary Ask the server for the compact binary packet format")
+        print("--heartbeat=N Send a keepalive every N times the packet timeout,")
+        print("              0 sends none, defaults to %d" % util.HEARTBEAT_TIMEOUTS)
+        print("--delayed-acks Delay acks and piggyback them on outgoing packets")
+        print("--coalesce Pack small messages to the server into one")
+        print("--compress Compress large messages, and ask the server to do the same")
+        print("--engine=ENGINE The event loop, threads (default: a receive thread and")
+        print("                input on the main thread) or selector (one thread)")
         print("-h | --help Print this help")
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "u:p:a:w", ["user=", "port=", "address=","window="])
+                                   "u:p:a:w:", ["user=", "port=", "address=","window=","binary",
+                                                "heartbeat=","delayed-acks","coalesce",
+                                                "compress","engine="])
     except getopt.error:
         helper()
         exit(1)
@@ -159,22 +481,50 @@ if __name__ == "__main__":
     DEST = "localhost"
     USER_NAME = None
     WINDOW_SIZE = 3
+    BINARY = False
+    HEARTBEAT = util.HEARTBEAT_TIMEOUTS * util.TIME_OUT
+    DELAYED_ACKS = False
+    COALESCE = False
+    COMPRESS = False
+    ENGINE = "threads"
     for o, a in OPTS:
-        if o in ("-u", "--user="):
+        if o in ("-u", "--user"):
             USER_NAME = a
-        elif o in ("-p", "--port="):
+        elif o in ("-p", "--port"):
             PORT = int(a)
-        elif o in ("-a", "--address="):
+        elif o in ("-a", "--address"):
             DEST = a
-        elif o in ("-w", "--window="):
-            WINDOW_SIZE = a
+        elif o in ("-w", "--window"):
+            WINDOW_SIZE = int(a)
+        elif o == "--binary":
+            BINARY = True
+        elif o == "--heartbeat":
+            HEARTBEAT = float(a) * util.TIME_OUT
+        elif o == "--delayed-acks":
+            DELAYED_ACKS = True
+        elif o == "--coalesce":
+            COALESCE = True
+        elif o == "--compress":
+            COMPRESS = True
+        elif o == "--engine":
+            if a not in ("threads", "selector"):
+                helper()
+                exit(1)
+            ENGINE = a
 
     if USER_NAME is None:
         print("Missing Username.")
         helper()
         exit(1)
 
-    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE)
+    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE, BINARY, HEARTBEAT, DELAYED_ACKS, COALESCE,
+               COMPRESS)
+    if ENGINE == "selector":
+        try:
+            S.run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
     try:
         # Start receiving Messages
         T = Thread(target=S.receive_handler)
@@ -0,0 +1,120 @@
+'''
+This module takes the output of the Server off its event loop.
+
+EventLog.log() only appends the line to an in-memory buffer; a background thread
+writes whatever accumulated every `interval` seconds, as one write per batch. The
+buffer holds at most `capacity` lines. When it is full the "block" policy writes the
+buffer out in the caller, so no line is ever lost, and the "drop" policy discards
+the new line and counts it. close() writes out everything left, and the Server calls
+it when it is interrupted. The lines and their order are exactly what print() would
+have written.
+'''
+import os
+import sys
+import threading
+from collections import deque
+
+LOG_CAPACITY = 65536 # lines buffered before the drop policy applies
+LOG_INTERVAL = 0.05 # seconds between two batches of the flusher thread
+
+
+class EventLog:
+    '''
+    Buffered, batched replacement for print() of whole lines.
+    '''
+    def __init__(self, stream=None, capacity=LOG_CAPACITY, policy="block", interval=LOG_INTERVAL):
+        if policy not in ("block", "drop"):
+            raise ValueError("unknown policy %r" % policy)
+        self.stream = stream # None writes to whatever sys.stdout is at the time
+        self.capacity = capacity
+        self.policy = policy
+        self.interval = interval
+        self.lines = deque()
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock() # keeps batches in order
+        self.thread = None
+        self.pid = None # process the flusher thread runs in, threads do not survive fork
+        self.closed = False
+        # counters, see stats()
+        self.logged = 0
+        self.batches = 0
+        self.dropped = 0
+        self.overflows = 0 # batches the "block" policy wrote in the caller
+
+    def log(self, line):
+        '''
+        Queues one line, written without its trailing newline like print(line)
+        '''
+        if self.closed:
+            self._write(line + "\n")
+            return
+        if len(self.lines) >= self.capacity:
+            if self.policy == "drop":
+                self.dropped += 1
+                return
+            self.overflows += 1
+            self.flush()
+        with self.cond:
+            self.lines.append(line)
+            self.logged += 1
+            if self.pid != os.getpid():
+                self._start()
+
+    def flush(self):
+        '''
+        Writes every queued line now
+        '''
+        with self.write_lock:
+            with self.cond:
+                if not self.lines:
+                    return
+                batch = list(self.lines)
+                self.lines.clear()
+            batch.append("")
+            self._write("\n".join(batch))
+            self.batches += 1
+
+    def close(self):
+        '''
+        Stops the flusher thread and writes every queued line. Later lines are written
+        directly.
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join()
+        self.flush()
+
+    def stats(self):
+        '''
+        Returns the logger counters and the lines written per batch
+        '''
+        return {
+            "logged": self.logged,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "queued": len(self.lines),
+            "lines_per_batch": (self.logged - len(self.lines)) / self.batches if self.batches else 0.0,
+        }
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.closed:
+                    self.cond.wait(self.interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                return
+
+    def _write(self, text):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(text)
+        stream.flush()
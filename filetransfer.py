@@ -0,0 +1,144 @@
+'''
+This module moves files through the reliable transport without holding them in memory.
+
+A file travels as one streamed message (see ReliableTransport.send_stream()): its
+header, a send_file or forward_file message naming the file, rides in the start
+packet and the contents of the file fill the data packets. The sender maps the
+file with mmap and every data packet is cut from the mapping when it is sent, so
+only the packets in flight are ever copied. The receiver writes every fragment at
+its offset in the destination file as it arrives, in any order. The server writes
+into a spool file and relays the finished file from a mapping of the spool, to all
+the recipients at once, so the memory of every party stays the same whatever the
+size of the file.
+
+Files sent to the server carry the SHA-256 digest of their contents in the start
+packet. A transfer the server can serve from its ChunkCache (see chunkcache.py),
+or which an interrupted transfer of the same contents left half done, is resumed:
+the ack of the start packet already covers the fragments the server holds, so the
+sender skips straight past them. The server hashes the contents as the fragments
+arrive in order, so that checking the digest of a complete file costs nothing more.
+'''
+import hashlib
+import mmap
+import os
+import tempfile
+import util
+
+
+def map_file(path):
+    '''
+    Returns the contents of the file at path as a read-only mmap, or b"" if it is empty
+    '''
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        # the mapping keeps its own handle on the file
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def file_digest(contents):
+    '''
+    Returns the hex SHA-256 digest of a bytes-like object, such as map_file() returns
+    '''
+    return hashlib.sha256(contents).hexdigest()
+
+
+class FileSink:
+    '''
+    Receiver of the contents of a streamed message, with the interface of
+    util.Reassembler: every fragment is written straight to its offset in a file.
+    A fragment that was already written is accepted again without effect, so that
+    a transfer may be resumed into the same sink. A hashed sink also hashes the
+    fragments as they come in order, for digest().
+    '''
+    __slots__ = ("path", "fd", "length", "size", "count", "received", "held", "hasher",
+                 "hashed")
+
+    def __init__(self, path, length, size=util.FRAGMENT_SIZE, fd=None, hashed=False):
+        self.path = path
+        self.fd = fd if fd is not None else os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                                                    0o644)
+        os.ftruncate(self.fd, length)
+        self.length = length
+        self.size = size
+        self.count = max(1, -(-length // size)) # number of fragments expected
+        self.received = 0
+        self.held = bytearray(self.count) # 1 for every fragment written
+        self.hasher = hashlib.sha256() if hashed else None
+        self.hashed = 0 # fragments from the start the hasher was fed
+
+    @classmethod
+    def spool(cls, length, directory=None, hashed=False):
+        '''
+        Returns a sink writing to a new temporary file in directory
+        '''
+        fd, path = tempfile.mkstemp(prefix="spool-", dir=directory)
+        return cls(path, length, fd=fd, hashed=hashed)
+
+    def add(self, index, data):
+        '''
+        Writes fragment number index. Returns False if it does not fit the file.
+        '''
+        offset = index * self.size
+        if index >= self.count or offset + len(data) > self.length:
+            return False
+        if self.held[index]:
+            return True
+        os.pwrite(self.fd, data, offset)
+        self.held[index] = 1
+        self.received += 1
+        if index == self.hashed and self.hasher is not None:
+            self.hasher.update(data)
+            self.hashed += 1
+            missing = self.held.find(0, self.hashed)
+            self._hash(self.count if missing < 0 else missing) # the fragments that came early
+        return True
+
+    def _hash(self, end):
+        # feeds the hasher the fragments before end it was not fed yet, from the file
+        while self.hashed < end:
+            offset = self.hashed * self.size
+            self.hasher.update(os.pread(self.fd, min(self.size, self.length - offset), offset))
+            self.hashed += 1
+
+    def complete(self):
+        return self.received >= self.count
+
+    def prefix(self):
+        '''
+        Returns the number of fragments written from the start of the file without a gap
+        '''
+        first_missing = self.held.find(0)
+        return self.count if first_missing < 0 else first_missing
+
+    def map(self):
+        '''
+        Returns the contents written so far as a read-only mmap, or b"" if empty
+        '''
+        if self.length == 0:
+            return b""
+        return mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+    def digest(self):
+        '''
+        Returns the hex SHA-256 digest of the contents, of a complete sink
+        '''
+        if self.hasher is None:
+            return file_digest(self.map())
+        self._hash(self.count)
+        return self.hasher.hexdigest()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def discard(self):
+        '''
+        Closes and deletes the file
+        '''
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,220 @@
+'''
+This module records the messages the server forwards, to answer history queries.
+
+Records are appended to segment files of a fixed SEGMENT_SIZE bytes, written and
+read through mmap. A record is `<time> <body length> <sender length> <recipients
+length>` packed by RECORD, then the sender, the space-separated recipients and the
+body; the zero bytes after the last record of a segment mark its end. At most
+MAX_SEGMENTS segments are kept, the oldest one is deleted when a new one starts.
+
+The index is made of arrays, never of objects per record: the time and position of
+every record by record number, and per recipient and per (recipient, sender) the
+numbers of the records they received, in order. Record numbers and times only grow,
+so the last N records of a recipient are the end of its array and the records since
+some time are found by bisection: every query costs O(log n) plus what it returns.
+Dropping the oldest segment trims the arrays of its records, and forgets the
+recipients that have none left.
+Opening an existing directory rebuilds the index from the segments.
+'''
+import bisect
+import mmap
+import os
+import struct
+import time
+from array import array
+
+RECORD = struct.Struct("!dIHH") # time, body length, sender length, recipients length
+SEGMENT_SIZE = 4 << 20 # bytes per segment file
+MAX_SEGMENTS = 64
+SEGMENT_BITS = 32 # a position is segment << SEGMENT_BITS | offset
+
+
+class HistoryStore:
+    '''
+    Bounded on-disk history of forwarded messages, indexed by time, recipient and sender.
+    '''
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.maps = {} # segment : mmap
+        self.segment = -1 # segment being appended to
+        self.offset = 0 # end of its records
+        self.first = 0 # number of the oldest record kept
+        self.times = array("d") # record number - first : time
+        self.positions = array("Q") # record number - first : position
+        self.received = {} # recipient : array of record numbers
+        self.received_from = {} # (recipient, sender) : array of record numbers
+        self.left = {} # username : time it last left, for catch-up queries
+        self.recover()
+
+    def path(self, segment):
+        return os.path.join(self.directory, "history-%08d.seg" % segment)
+
+    def recover(self):
+        '''
+        Rebuilds the index from the segments on disk
+        '''
+        segments = sorted(int(name[8:16]) for name in os.listdir(self.directory)
+                          if name.startswith("history-") and name.endswith(".seg"))
+        for segment in segments:
+            self._map(segment)
+            mapped = self.maps[segment]
+            offset = 0
+            while offset + RECORD.size <= len(mapped):
+                when, length, sender_length, recipients_length = RECORD.unpack_from(mapped, offset)
+                if when == 0:
+                    break # end of the records
+                start = offset + RECORD.size
+                sender = mapped[start:start + sender_length].decode("utf-8")
+                recipients = mapped[start + sender_length:
+                                    start + sender_length + recipients_length].decode("utf-8")
+                self._index(when, segment, offset, sender, recipients.split())
+                offset = start + sender_length + recipients_length + length
+            self.segment, self.offset = segment, offset
+
+    def _map(self, segment):
+        fd = os.open(self.path(segment), os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size != self.segment_size:
+                os.ftruncate(fd, self.segment_size) # zero filled: no records yet
+            self.maps[segment] = mmap.mmap(fd, self.segment_size)
+        finally:
+            os.close(fd)
+
+    def _index(self, when, segment, offset, sender, recipients):
+        number = self.first + len(self.times)
+        self.times.append(when)
+        self.positions.append(segment << SEGMENT_BITS | offset)
+        for recipient in recipients:
+            for key, table in ((recipient, self.received),
+                               ((recipient, sender), self.received_from)):
+                numbers = table.get(key)
+                if numbers is None:
+                    numbers = table[key] = array("Q")
+                numbers.append(number)
+
+    def append(self, sender, recipients, body, now=None):
+        '''
+        Records a message body, str, that sender sent to the list of recipients
+        '''
+        now = time.time() if now is None else now
+        sender_bytes = sender.encode("utf-8")
+        recipients_bytes = ' '.join(recipients).encode("utf-8")
+        body_bytes = body.encode("utf-8")
+        size = RECORD.size + len(sender_bytes) + len(recipients_bytes) + len(body_bytes)
+        if size + RECORD.size > self.segment_size:
+            return # would not fit any segment
+        if self.segment < 0 or self.offset + size + RECORD.size > self.segment_size:
+            self._roll()
+        mapped = self.maps[self.segment]
+        offset = self.offset
+        RECORD.pack_into(mapped, offset, now, len(body_bytes), len(sender_bytes),
+                         len(recipients_bytes))
+        offset += RECORD.size
+        for part in (sender_bytes, recipients_bytes, body_bytes):
+            mapped[offset:offset + len(part)] = part
+            offset += len(part)
+        self._index(now, self.segment, self.offset, sender, recipients)
+        self.offset = offset
+
+    def _roll(self):
+        # starts the next segment, dropping the oldest one beyond max_segments
+        if self.segment >= 0:
+            self.maps[self.segment].flush()
+        self.segment += 1
+        self.offset = 0
+        self._map(self.segment)
+        while len(self.maps) > self.max_segments:
+            oldest = min(self.maps)
+            self.maps.pop(oldest).close()
+            os.unlink(self.path(oldest))
+            # the records of the oldest segment come first
+            dropped = bisect.bisect_left(self.positions, (oldest + 1) << SEGMENT_BITS)
+            del self.times[:dropped]
+            del self.positions[:dropped]
+            self.first += dropped
+            self._trim()
+
+    def _trim(self):
+        # drops the numbers of the records dropped from the arrays of the recipients,
+        # and the recipients left with none
+        for table in (self.received, self.received_from):
+            for key, numbers in list(table.items()):
+                if numbers[0] >= self.first:
+                    continue
+                kept = bisect.bisect_left(numbers, self.first)
+                if kept == len(numbers):
+                    del table[key]
+                else:
+                    del numbers[:kept]
+
+    def read(self, number):
+        '''
+        Returns (time, sender, body) of a record. Raises IndexError if it was dropped
+        or never written.
+        '''
+        if not self.first <= number < self.first + len(self.positions):
+            raise IndexError("no record %d" % number)
+        position = self.positions[number - self.first]
+        mapped = self.maps[position >> SEGMENT_BITS]
+        offset = position & ((1 << SEGMENT_BITS) - 1)
+        when, length, sender_length, recipients_length = RECORD.unpack_from(mapped, offset)
+        start = offset + RECORD.size
+        sender = mapped[start:start + sender_length].decode("utf-8")
+        start += sender_length + recipients_length
+        return when, sender, mapped[start:start + length].decode("utf-8", errors="replace")
+
+    def last(self, recipient, count, sender=None):
+        '''
+        Returns the numbers of the last count records recipient received, from sender if given
+        '''
+        numbers = self.received.get(recipient) if sender is None else \
+            self.received_from.get((recipient, sender))
+        if not numbers or count <= 0:
+            return array("Q")
+        return numbers[max(len(numbers) - count, 0):]
+
+    def since(self, recipient, when):
+        '''
+        Returns the numbers of the records recipient received after the given time
+        '''
+        numbers = self.received.get(recipient, array("Q"))
+        start = bisect.bisect_right(numbers, when, key=lambda number: self.times[number - self.first])
+        return numbers[start:]
+
+    def leave(self, username, now=None):
+        '''
+        Notes the time username left, for catch_up()
+        '''
+        self.left[username] = time.time() if now is None else now
+
+    def catch_up(self, recipient, count):
+        '''
+        Returns the numbers of the records recipient received since it last left, or of
+        the last count records if it never left
+        '''
+        when = self.left.get(recipient)
+        if when is None:
+            return self.last(recipient, count)
+        return self.since(recipient, when)
+
+    def stats(self):
+        '''
+        Returns the size of the history and of its index
+        '''
+        index = self.times.itemsize * len(self.times) + self.positions.itemsize * len(self.positions)
+        for table in (self.received, self.received_from):
+            index += sum(numbers.itemsize * len(numbers) for numbers in table.values())
+        return {"records": len(self.times), "segments": len(self.maps), "index_bytes": index,
+                "recipients": len(self.received)}
+
+    def close(self):
+        '''
+        Writes the segments out and unmaps them
+        '''
+        for mapped in self.maps.values():
+            mapped.flush()
+            mapped.close()
+        self.maps.clear()
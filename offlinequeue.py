@@ -0,0 +1,306 @@
+'''
+This module keeps the messages sent to users who are offline until they join again.
+
+Messages are appended to a log cut into segment files of at most `segment_size`
+bytes. Each record is `<length> <name length> <crc32>` packed by RECORD, then the
+recipient's username and the message. The only thing kept in memory per message is
+its position in the log, 8 bytes in an array per recipient; the messages themselves
+are read back from the log when they are sent, oldest first. A message only counts
+as delivered once the recipient acknowledged it (ack()); until then a failed delivery
+sends it again (rewind()). A segment whose messages were all delivered is deleted,
+once the log moved on to the next one.
+
+What was delivered is recorded in a cursors file, a line `<username> <position>` per
+ack giving the position of the last message delivered to the user, so that opening
+the directory again does not deliver it twice. The file is compacted on opening.
+
+Appends and cursors go through a buffer and reach the disk with one fsync per batch:
+sync() writes them out once `sync_interval` seconds passed since the first unsynced
+one, so a crash loses at most that much, and delivers again at most that much. Opening an existing directory rebuilds the index
+from the segments, dropping a torn record at the end of the last one.
+
+Usernames that ever joined are remembered in a file of their own, one per line;
+messages are only queued for those.
+'''
+import binascii
+import os
+import struct
+import time
+from array import array
+
+RECORD = struct.Struct("!IHI") # message length, username length, crc32 of both
+SEGMENT_SIZE = 16 << 20 # bytes per segment file
+SYNC_INTERVAL = 0.05 # longest an append waits for its fsync, in seconds
+SEGMENT_BITS = 32 # a position is segment << SEGMENT_BITS | offset
+
+
+class OfflineQueue:
+    '''
+    Durable per-recipient message queues over a segmented append-only log.
+    '''
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, sync_interval=SYNC_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        # username : [array of positions, number delivered, number sent]
+        self.index = {}
+        self.live = {} # segment : messages in it not delivered yet
+        self.readers = {} # segment : fd, opened on first read
+        self.writer = None # buffered file of the segment being appended to
+        self.segment = 0 # number of that segment
+        self.offset = 0 # its size
+        self.sync_due = None # time the buffered appends must be synced by
+        self.known = set()
+        self.users = None # file of known usernames
+        self.cursors = None # file of delivery cursors
+        self.cursors_dirty = False # cursors written since the last sync
+        # counters, see stats()
+        self.appended = 0
+        self.delivered = 0
+        self.syncs = 0
+        self.synced = 0 # appends covered by those syncs
+        self.unsynced = 0
+        self.recover()
+
+    def path(self, segment):
+        return os.path.join(self.directory, "segment-%08d.log" % segment)
+
+    def recover(self):
+        '''
+        Rebuilds the index from the segments and the known usernames from their file
+        '''
+        users_path = os.path.join(self.directory, "users")
+        if os.path.exists(users_path):
+            with open(users_path, encoding="utf-8") as f:
+                self.known.update(line.rstrip("\n") for line in f if line.strip())
+        self.users = open(users_path, "a", encoding="utf-8")
+        cursors_path = os.path.join(self.directory, "cursors")
+        cursors = {} # username : position of the last message delivered
+        if os.path.exists(cursors_path):
+            with open(cursors_path, encoding="utf-8") as f:
+                for line in f:
+                    username, _, position = line.rstrip("\n").rpartition(" ")
+                    try:
+                        position = int(position)
+                    except ValueError:
+                        continue # torn by a crash
+                    cursors[username] = max(position, cursors.get(username, -1))
+        segments = sorted(int(name[8:16]) for name in os.listdir(self.directory)
+                          if name.startswith("segment-") and name.endswith(".log"))
+        for segment in segments:
+            with open(self.path(segment), "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset + RECORD.size <= len(data):
+                length, name_length, crc = RECORD.unpack_from(data, offset)
+                end = offset + RECORD.size + name_length + length
+                if end > len(data) or binascii.crc32(data[offset + RECORD.size:end]) != crc:
+                    break # torn by a crash
+                name = data[offset + RECORD.size:offset + RECORD.size + name_length]
+                name = name.decode("utf-8")
+                if segment << SEGMENT_BITS | offset > cursors.get(name, -1):
+                    self._index(name, segment, offset)
+                offset = end
+            if offset < len(data):
+                with open(self.path(segment), "r+b") as f:
+                    f.truncate(offset)
+            if not self.live.get(segment):
+                os.unlink(self.path(segment))
+            self.segment, self.offset = segment, offset
+        if segments:
+            self.segment += 1 # never append after a torn record
+            self.offset = 0
+        # only the cursors into segments still kept matter
+        first = min(self.live, default=self.segment) << SEGMENT_BITS
+        with open(cursors_path + ".tmp", "w", encoding="utf-8") as f:
+            for username, position in cursors.items():
+                if position >= first:
+                    f.write("%s %d\n" % (username, position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(cursors_path + ".tmp", cursors_path)
+        self.cursors = open(cursors_path, "a", encoding="utf-8")
+
+    def _index(self, username, segment, offset):
+        entry = self.index.get(username)
+        if entry is None:
+            entry = self.index[username] = [array("Q"), 0, 0]
+        entry[0].append(segment << SEGMENT_BITS | offset)
+        self.live[segment] = self.live.get(segment, 0) + 1
+
+    def knows(self, username):
+        return username in self.known
+
+    def remember(self, username):
+        '''
+        Records that username joined, so that messages are queued for it when it is offline
+        '''
+        if username not in self.known:
+            self.known.add(username)
+            self.users.write(username + "\n")
+            self.users.flush()
+
+    def append(self, username, message):
+        '''
+        Queues a message, bytes or str, for username
+        '''
+        name = username.encode("utf-8")
+        if isinstance(message, str):
+            message = message.encode()
+        size = RECORD.size + len(name) + len(message)
+        if self.writer is None or (self.offset + size > self.segment_size and self.offset):
+            self._roll()
+        body = name + message
+        self.writer.write(RECORD.pack(len(message), len(name), binascii.crc32(body)))
+        self.writer.write(body)
+        self._index(username, self.segment, self.offset)
+        self.offset += size
+        self.appended += 1
+        self.unsynced += 1
+        if self.sync_due is None:
+            self.sync_due = time.time() + self.sync_interval
+
+    def _roll(self):
+        # starts the next segment
+        if self.writer is not None:
+            self.sync(force=True)
+            self.writer.close()
+            if not self.live.get(self.segment):
+                self._delete(self.segment)
+            self.segment += 1
+        self.offset = 0
+        self.writer = open(self.path(self.segment), "ab")
+
+    def pending(self, username):
+        '''
+        Returns the number of messages queued for username and not sent yet
+        '''
+        entry = self.index.get(username)
+        return len(entry[0]) - entry[2] if entry is not None else 0
+
+    def read(self, username, limit):
+        '''
+        Returns the oldest messages queued for username and not sent yet, as many as
+        fit in limit bytes but at least one, and counts them as sent
+        '''
+        entry = self.index.get(username)
+        if entry is None:
+            return []
+        positions, start = entry[0], entry[2]
+        messages = []
+        size = 0
+        if self.writer is not None:
+            self.writer.flush() # the newest records may still be in the buffer
+        while start < len(positions) and (not messages or size < limit):
+            segment = positions[start] >> SEGMENT_BITS
+            offset = positions[start] & ((1 << SEGMENT_BITS) - 1)
+            fd = self.readers.get(segment)
+            if fd is None:
+                fd = self.readers[segment] = os.open(self.path(segment), os.O_RDONLY)
+            length, name_length, _ = RECORD.unpack(os.pread(fd, RECORD.size, offset))
+            messages.append(os.pread(fd, length, offset + RECORD.size + name_length))
+            size += length
+            start += 1
+        entry[2] = start
+        return messages
+
+    def ack(self, username, count, now=None):
+        '''
+        Counts the oldest count messages sent to username and not delivered yet as
+        delivered, and records it in the cursors
+        '''
+        entry = self.index.get(username)
+        if entry is None:
+            return
+        positions, start, sent = entry
+        end = min(start + count, sent)
+        if end <= start:
+            return
+        for position in positions[start:end]:
+            segment = position >> SEGMENT_BITS
+            self.live[segment] -= 1
+            if not self.live[segment] and segment != self.segment:
+                self._delete(segment)
+        self.cursors.write("%s %d\n" % (username, positions[end - 1]))
+        self.cursors_dirty = True
+        if self.sync_due is None:
+            self.sync_due = (time.time() if now is None else now) + self.sync_interval
+        self.delivered += end - start
+        if end == len(positions):
+            del self.index[username]
+        elif end > len(positions) // 2:
+            del positions[:end] # keeps the array as long as what is left
+            entry[1], entry[2] = 0, sent - end
+        else:
+            entry[1] = end
+
+    def rewind(self, username):
+        '''
+        Counts the messages sent to username and not delivered as not sent, after
+        their delivery failed
+        '''
+        entry = self.index.get(username)
+        if entry is not None:
+            entry[2] = entry[1]
+
+    def _delete(self, segment):
+        self.live.pop(segment, None)
+        fd = self.readers.pop(segment, None)
+        if fd is not None:
+            os.close(fd)
+        os.unlink(self.path(segment))
+
+    def next_sync(self, now=None):
+        '''
+        Returns the number of seconds until sync() has appends to write out, or None
+        '''
+        if self.sync_due is None:
+            return None
+        now = time.time() if now is None else now
+        return max(0.0, self.sync_due - now)
+
+    def sync(self, now=None, force=False):
+        '''
+        Writes the buffered appends and cursors out with one fsync each once they are
+        due, or now if forced
+        '''
+        if self.sync_due is None:
+            return
+        now = time.time() if now is None else now
+        if not force and now < self.sync_due:
+            return
+        if self.cursors_dirty:
+            self.cursors.flush()
+            os.fsync(self.cursors.fileno())
+            self.cursors_dirty = False
+        if self.unsynced:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.syncs += 1
+            self.synced += self.unsynced
+            self.unsynced = 0
+        self.sync_due = None
+
+    def stats(self):
+        '''
+        Returns the queue counters and the appends per fsync
+        '''
+        return {"queued": self.appended - self.delivered, "recipients": len(self.index),
+                "appended": self.appended, "delivered": self.delivered,
+                "segments": len(self.live), "syncs": self.syncs,
+                "appends_per_sync": self.synced / self.syncs if self.syncs else 0.0}
+
+    def close(self):
+        '''
+        Syncs the log and closes its files
+        '''
+        self.sync(force=True)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        for fd in self.readers.values():
+            os.close(fd)
+        self.readers.clear()
+        self.users.close()
+        self.cursors.close()
@@ -0,0 +1,140 @@
+'''
+This module parses chat messages in a single pass over their bytes.
+
+A message is `<command> <length> <fields>`. For send_message, forward_message,
+send_file and forward_file the fields are `<count> <name_1> ... <name_count> <body>`
+(the body of a file message is the name of the file); for every other command they
+are just names (the username and capabilities of a join, the usernames of a users
+list). parse_message() tokenises the bytes in place with compiled patterns, which
+copy nothing, and keeps the offsets they end at: one pattern checks the command,
+length and count, and also steps over the name of a message to a single recipient,
+the common case, and one pattern per count steps over the names of the others. It
+decodes nothing but the command; the names and the body are cut out and decoded
+when asked for. Fields are separated by single spaces, as util.make_message()
+writes them, so the body keeps its spacing.
+
+A batch message packs several messages, each prefixed with its length in bytes;
+unbatch() returns them as slices to be parsed one by one. A response_history page
+packs the forward_messages of the history the same way.
+'''
+import re
+import util
+
+# commands whose fields start with a count of names followed by a free-form body
+COUNTED_COMMANDS = (util.SEND_MESSAGE_MESSAGE, util.FORWARD_MESSAGE_MESSAGE,
+                    util.SEND_FILE_MESSAGE, util.FORWARD_FILE_MESSAGE)
+BATCH_PREFIX = util.BATCH_MESSAGE.encode() + b" "
+HISTORY_PREFIX = util.RESPONSE_HISTORY_MESSAGE.encode() + b" "
+# either a counted command to a single name, up to its body (group 1 the command,
+# group 2 empty at the name), or the command, the length and the word after them,
+# the count of a counted command (groups 3 to 5)
+HEADER = re.compile(rb"(?:(%s) \d* 1 ()[^ ]* |([^ ]+)(?:$| (\d*)(?:$| ([^ ]*) ?)))" %
+                    b"|".join(command.encode() for command in COUNTED_COMMANDS))
+NAMES_PATTERNS = {} # count : pattern matching that many names
+# the commands a peer sends, by their bytes, so parsing them decodes nothing
+COMMANDS = {getattr(util, name).encode(): getattr(util, name)
+            for name in dir(util) if name.endswith("_MESSAGE") and name.isupper()}
+
+
+class Message:
+    '''
+    A parsed message: offsets into the bytes it was parsed from. names() and body()
+    decode their part of the message on demand.
+    '''
+    __slots__ = ("command", "count", "data", "names_start", "body_start")
+
+    def __init__(self, command, count, data, names_start, body_start):
+        self.command = command
+        self.count = count # number of names for counted commands, else None
+        self.data = data # the bytes-like object parsed, not copied
+        self.names_start = names_start # offset of the names in data
+        self.body_start = body_start # offset of the body, len(data) if it has none
+
+    @property
+    def length(self):
+        '''
+        The length field: the parser only checks that it is a number
+        '''
+        words = self.data[:self.names_start].split(None, 2)
+        return int(words[1]) if len(words) > 1 and words[1] else 0
+
+    def names(self):
+        '''
+        Returns the names: recipients, the sender of a forward, the usernames of a list...
+        '''
+        return self.data[self.names_start:self.body_start].decode("utf-8", "replace").split()
+
+    def body(self):
+        '''
+        Returns the free-form text after the names
+        '''
+        return self.data[self.body_start:].decode("utf-8", "replace")
+
+    def __repr__(self):
+        return "Message(%r, %r, %r)" % (self.command, self.names(), self.body())
+
+
+def unbatch(data, prefix=BATCH_PREFIX):
+    '''
+    Returns the messages held in data: the ones a batch message made by
+    util.make_batch() packs, or data itself. Raises ValueError if a batch is malformed.
+    prefix is the command of the batch and a space.
+    '''
+    if not data.startswith(prefix):
+        return [data]
+    words = data.split(None, 2)
+    body = words[2] if len(words) > 2 else b""
+    messages = []
+    start = 0
+    while start < len(body):
+        space = body.index(b" ", start)
+        end = space + 1 + int(body[start:space])
+        if end > len(body):
+            raise ValueError("truncated batch")
+        messages.append(body[space + 1:end])
+        start = end + 1
+    return messages
+
+
+def names_pattern(count):
+    '''
+    Returns the pattern matching count names, each followed by its space. The
+    patterns of the counts a client can send are compiled once.
+    '''
+    pattern = NAMES_PATTERNS.get(count)
+    if pattern is None:
+        pattern = re.compile(rb"(?:[^ ]* ){%d}" % count)
+        if count <= util.MAX_NUM_CLIENTS:
+            NAMES_PATTERNS[count] = pattern
+    return pattern
+
+
+def parse_message(data):
+    '''
+    Parses a message held in a bytes-like object, such as bytes or the bytearray a
+    message is reassembled into. Raises ValueError if it is malformed.
+    '''
+    match = HEADER.match(data)
+    if match is None:
+        raise ValueError("malformed message")
+    if match[1] is not None:
+        return Message(COMMANDS[match[1]], 1, data, match.start(2), match.end())
+    # the length is checked by the pattern, and parsed when asked for
+    command = COMMANDS.get(match[3]) or match[3].decode("utf-8", "replace")
+    end = len(data)
+
+    if command not in COUNTED_COMMANDS:
+        names_start = match.start(5)
+        return Message(command, None, data, names_start if names_start >= 0 else end, end)
+
+    count = match[5]
+    names_start = match.end()
+    if not count:
+        raise ValueError("missing count")
+    count = int(count)
+    if count < 0:
+        raise ValueError("negative count")
+    # each name takes a space at least: with fewer bytes left, the names run to the end
+    match = None if count > end - names_start else (
+        NAMES_PATTERNS.get(count) or names_pattern(count)).match(data, names_start)
+    return Message(command, count, data, names_start, end if match is None else match.end())
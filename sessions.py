@@ -0,0 +1,139 @@
+'''
+This module keeps track of the clients that are currently joined to the server.
+Both directions of the mapping (username -> address and address -> session) are
+kept in step so that the server never has to scan the table to find a sender.
+
+The table is kept small enough for rooms of 100k users: sessions are __slots__
+objects, usernames are interned so the maps and the sorted list share one string,
+and addresses are stored packed into a single integer instead of an (ip, port) tuple.
+What a connection needs, windows and sequence numbers, is the transport's business
+and lives there, keyed by address; bench.py sessionmemory measures both tables.
+'''
+import bisect
+import socket
+import sys
+import time
+
+
+def pack_address(address):
+    '''
+    Returns an (ip, port) IPv4 address packed into one integer
+    '''
+    ip, port = address
+    return int.from_bytes(socket.inet_aton(ip), "big") << 16 | port
+
+
+def unpack_address(key):
+    '''
+    Returns the (ip, port) address packed by pack_address()
+    '''
+    return socket.inet_ntoa((key >> 16).to_bytes(4, "big")), key & 0xffff
+
+
+class Session:
+    '''
+    State the server keeps for one joined client.
+    '''
+    __slots__ = ("username", "key", "last_seen")
+
+    def __init__(self, username, key, last_seen=0.0):
+        self.username = username
+        self.key = key # packed address
+        self.last_seen = last_seen # time the client was last heard from
+
+    @property
+    def address(self):
+        return unpack_address(self.key)
+
+    def __repr__(self):
+        return "Session(%r, %r)" % (self.username, self.address)
+
+
+class SessionRegistry:
+    '''
+    Registry of joined clients with O(1) lookup by username and by address.
+    '''
+    def __init__(self):
+        self.addresses = {} # username : packed address
+        self.sessions = {} # packed address : Session
+        self.sorted = [] # usernames in sorted order, kept up to date by insert/evict
+        self.version = 0 # bumped on every membership change
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __contains__(self, username):
+        return username in self.addresses
+
+    def lookup(self, address):
+        '''
+        Returns the session joined from the given address, or None
+        '''
+        return self.sessions.get(pack_address(address))
+
+    def username_of(self, address):
+        '''
+        Returns the username joined from the given address, or None
+        '''
+        session = self.sessions.get(pack_address(address))
+        if session is None:
+            return None
+        return session.username
+
+    def address_of(self, username):
+        '''
+        Returns the address the given username joined from, or None
+        '''
+        key = self.addresses.get(username)
+        if key is None:
+            return None
+        return unpack_address(key)
+
+    def insert(self, username, address, now=None):
+        '''
+        Registers a new session. A previous session on the same address or with the
+        same username is replaced.
+        '''
+        if username in self.addresses:
+            self.evict(username)
+        key = pack_address(address)
+        previous = self.sessions.get(key)
+        if previous is not None:
+            self.addresses.pop(previous.username, None)
+            self._unsort(previous.username)
+        username = sys.intern(username)
+        session = Session(username, key, time.time() if now is None else now)
+        self.addresses[username] = key
+        self.sessions[key] = session
+        bisect.insort(self.sorted, username)
+        self.version += 1
+        return session
+
+    def evict(self, username):
+        '''
+        Removes the session of the given username and returns it, or None
+        '''
+        key = self.addresses.pop(username, None)
+        if key is None:
+            return None
+        self._unsort(username)
+        self.version += 1
+        return self.sessions.pop(key, None)
+
+    def _unsort(self, username):
+        i = bisect.bisect_left(self.sorted, username)
+        if i < len(self.sorted) and self.sorted[i] == username:
+            del self.sorted[i]
+
+    def usernames(self):
+        '''
+        Returns the usernames of all joined clients
+        '''
+        return self.addresses.keys()
+
+    def sorted_usernames(self):
+        '''
+        Returns the usernames of all joined clients in sorted order.
+        The list is owned by the registry and must not be modified.
+        '''
+        return self.sorted
@@ -0,0 +1,400 @@
+'''
+This module runs the Server as several worker processes sharing one port.
+
+Every worker binds its own socket with SO_REUSEPORT, so the kernel spreads clients
+over the workers and keeps sending each client to the same one. The directory of
+joined usernames lives in a coordinator process (a multiprocessing Manager) so that
+every worker sees the same membership. Each worker keeps its own copy of the
+directory for lookups and brings it up to date from a log of the membership changes
+when the shared version, a counter in shared memory, moved: a lookup never leaves
+the process. A message for a recipient that joined through
+another worker is handed to that worker over its control channel: the recipient's
+acks reach the worker that owns it, so that worker has to do the sending. The control
+channels are Unix socket pairs created before the workers fork, so no other process
+can send on them. A message too large for one control datagram is handed over in a
+spool file, and a file as a hard link to the spool file it was received into; a
+worker only opens spool files of the spool directory. A handover that fails is
+counted in handover_failures and does not stop the worker.
+'''
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import sys
+import tempfile
+from multiprocessing.managers import SyncManager
+from server_1 import Server
+from filetransfer import map_file
+from sessions import SessionRegistry
+
+CONTROL_LIMIT = 60000 # bytes of a handover sent in the control datagram itself
+
+
+class SharedDirectory:
+    '''
+    The state the workers share: the directory and the log of its changes in the
+    coordinator, the lock and the counters in shared memory, inherited through fork.
+    '''
+    def __init__(self, manager, context):
+        self.directory = manager.dict() # username : (client_address, worker_id)
+        self.changes = manager.list() # (username, entry or None) since the last compaction
+        self.lock = context.RLock() # held across the checks and insert of a join
+        # written under the lock only
+        self.version = context.Value("q", 0, lock=False) # membership changes so far
+        self.base = context.Value("q", 0, lock=False) # version at the last compaction
+        self.epoch = context.Value("q", 0, lock=False) # number of compactions
+        self.members = context.Value("q", 0, lock=False)
+
+
+class SharedSessionRegistry:
+    '''
+    SessionRegistry whose membership is shared by all workers.
+    Sessions joined through this worker are also kept locally, so looking up the
+    sender of a datagram never leaves the process, and so is a copy of the whole
+    directory, refreshed from the log of changes when the shared version moved.
+    '''
+    def __init__(self, shared, worker_id):
+        self.shared = shared
+        self.lock = shared.lock
+        self.worker_id = worker_id
+        self.local = SessionRegistry()
+        self.owners = {} # address : worker_id, for recipients resolved through the directory
+        self.cache = {} # username : (client_address, worker_id), copy of the directory
+        self.applied = 0 # version of the copy
+        self.epoch = 0
+        self.refreshes = 0
+
+    def refresh(self):
+        '''
+        Brings the copy of the directory up to date, if the shared version moved
+        '''
+        shared = self.shared
+        if shared.version.value == self.applied:
+            return
+        with self.lock:
+            version = shared.version.value
+            if shared.epoch.value != self.epoch:
+                # the log was compacted past our copy: start over from the directory
+                self.cache = {username: (tuple(address), worker_id) for username, (
+                    address, worker_id) in shared.directory.items()}
+                self.epoch = shared.epoch.value
+                addresses = {address for address, _ in self.cache.values()}
+                self.owners = {address: worker_id for address, worker_id
+                               in self.owners.items() if address in addresses}
+            else:
+                base = shared.base.value
+                for username, entry in shared.changes[self.applied - base:version - base]:
+                    previous = self.cache.pop(username, None)
+                    if previous is not None:
+                        self.owners.pop(previous[0], None) # left, or joined again
+                    if entry is not None:
+                        self.cache[username] = (tuple(entry[0]), entry[1])
+            self.applied = version
+            self.refreshes += 1
+
+    def _change(self, username, entry):
+        # records a membership change, the lock is held
+        shared = self.shared
+        if entry is None:
+            del shared.directory[username]
+            shared.members.value -= 1
+        else:
+            if username not in self.cache:
+                shared.members.value += 1
+            shared.directory[username] = entry
+        shared.changes.append((username, entry))
+        shared.version.value += 1
+        if shared.version.value - shared.base.value > 2 * shared.members.value + 1024:
+            del shared.changes[:]
+            shared.base.value = shared.version.value
+            shared.epoch.value += 1
+
+    def __len__(self):
+        self.refresh()
+        return len(self.cache)
+
+    def __contains__(self, username):
+        self.refresh()
+        return username in self.cache
+
+    def lookup(self, address):
+        return self.local.lookup(address)
+
+    def username_of(self, address):
+        return self.local.username_of(address)
+
+    def address_of(self, username):
+        self.refresh()
+        entry = self.cache.get(username)
+        if entry is None:
+            return None
+        address, worker_id = entry
+        address = tuple(address)
+        self.owners[address] = worker_id
+        return address
+
+    def owner_of(self, address):
+        '''
+        Returns the id of the worker the client at address joined through
+        '''
+        if self.local.lookup(address) is not None:
+            return self.worker_id
+        return self.owners.get(address, self.worker_id)
+
+    @property
+    def version(self):
+        return self.shared.version.value
+
+    def insert(self, username, address, now=None):
+        session = self.local.insert(username, address, now)
+        with self.lock:
+            self.refresh()
+            self._change(username, (address, self.worker_id))
+        return session
+
+    def evict(self, username):
+        with self.lock:
+            self.refresh()
+            if username in self.cache:
+                self._change(username, None)
+        session = self.local.evict(username)
+        if session is not None:
+            self.owners.pop(session.address, None)
+        return session
+
+    def usernames(self):
+        self.refresh()
+        return list(self.cache)
+
+    def sorted_usernames(self):
+        self.refresh()
+        return sorted(self.cache)
+
+
+class ShardedServer(Server):
+    '''
+    One worker of a sharded server.
+    '''
+    def __init__(self, dest, port, window, worker_id, shared, channels, **options):
+        Server.__init__(self, dest, port, window, reuse_port=True, **options)
+        self.worker_id = worker_id
+        self.active_clients = SharedSessionRegistry(shared, worker_id)
+        # (receiving end, sending end) of the control channel of each worker
+        self.control = channels[worker_id][0]
+        self.controls = [sending for _, sending in channels]
+        self.handover_failures = 0
+
+    def spool_path(self, path):
+        '''
+        Returns path resolved if it names a spool file directly in the spool directory,
+        or None: a handover never makes a worker open or unlink any other file
+        '''
+        directory = os.path.realpath(self.spool_dir or tempfile.gettempdir())
+        path = os.path.realpath(path)
+        if os.path.dirname(path) != directory or \
+                not os.path.basename(path).startswith(("spool-", "handover-")):
+            return None
+        return path
+
+    def start(self):
+        '''
+        Main loop, serving both the client socket and the control socket
+        '''
+        self.control.setblocking(False)
+        while True:
+            ready, _, _ = select.select([self.sock, self.control], [], [],
+                                        self.next_timeout())
+            if self.control in ready:
+                self.handle_control(self.control.recv(65535))
+            if self.sock in ready:
+                for msg, length, client in self.io.drain():
+                    self.handle_datagram(msg, client, length)
+            self.tick()
+            self.io.flush()
+
+    def send(self, client, message):
+        '''
+        Sends a message to a client, through the worker it joined on
+        '''
+        self.send_many((client,), message)
+
+    def send_many(self, clients, message):
+        '''
+        Sends a message to several clients: ours directly, and the others with
+        one handover per worker that owns some of them
+        '''
+        by_owner = {}
+        for client in clients:
+            by_owner.setdefault(self.active_clients.owner_of(client), []).append(client)
+        for owner, owned in by_owner.items():
+            if owner == self.worker_id:
+                self.transport.send_many(owned, message)
+                continue
+            header = ' '.join("%s:%d" % client for client in owned)
+            self.hand_over(owner, header, message)
+
+    def hand_over(self, owner, header, message):
+        '''
+        Sends a message, str or bytes, and the header naming its recipients to another
+        worker: in the control datagram, or in a spool file if it is too large
+        '''
+        if isinstance(message, str):
+            message = message.encode()
+        spool = None
+        try:
+            if len(header) + len(message) + 1 > CONTROL_LIMIT:
+                fd, spool = tempfile.mkstemp(prefix="handover-", dir=self.spool_dir)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(message)
+                header, message = "spool %s %s" % (spool, header), b""
+            self.controls[owner].send(header.encode() + b"\n" + message)
+        except OSError:
+            self.handover_failures += 1
+            if spool is not None:
+                os.unlink(spool)
+
+    def forward_file(self, clients, header, sink):
+        '''
+        Streams a file to several clients: ours directly, and for each worker that owns
+        some of the others, a link to the spool file that worker streams from
+        '''
+        by_owner = {}
+        for client in clients:
+            by_owner.setdefault(self.active_clients.owner_of(client), []).append(client)
+        for owner, owned in by_owner.items():
+            if owner == self.worker_id:
+                continue
+            link = "%s.%d" % (sink.path, owner)
+            try:
+                os.link(sink.path, link)
+            except OSError:
+                self.handover_failures += 1
+                continue
+            handover = ' '.join(["file", link] + ["%s:%d" % client for client in owned])
+            try:
+                self.controls[owner].send((handover + "\n" + header).encode())
+            except OSError:
+                self.handover_failures += 1
+                os.unlink(link)
+        Server.forward_file(self, by_owner.get(self.worker_id, []), header, sink)
+
+    def handle_control(self, datagram):
+        '''
+        Sends a message or file handed over by another worker to some of our clients
+        '''
+        header, _, message = datagram.partition(b"\n")
+        words = header.decode().split()
+        kind = link = None
+        if words and words[0] in ("file", "spool"):
+            kind, link = words[0], self.spool_path(words[1])
+            words = words[2:]
+            if link is None:
+                self.handover_failures += 1
+                return
+        clients = []
+        for client in words:
+            ip, port = client.rsplit(":", 1)
+            clients.append((ip, int(port)))
+        if kind == "spool":
+            try:
+                with open(link, "rb") as f:
+                    message = f.read()
+                os.unlink(link)
+            except OSError:
+                self.handover_failures += 1
+                return
+        if kind != "file":
+            self.transport.send_many(clients, message)
+            return
+        try:
+            contents = map_file(link)
+            os.unlink(link) # the mapping keeps the contents
+        except OSError:
+            self.handover_failures += 1
+            return
+        self.transport.send_stream(clients, message, contents)
+
+    def handle_join(self, message, client):
+        # no other worker may join the same name or fill the last slot meanwhile
+        with self.active_clients.lock:
+            Server.handle_join(self, message, client)
+
+
+class LineWriter:
+    '''
+    Replacement for the stdout of a worker. The workers share the same output file,
+    so each complete line goes out in a single write(2) and never interleaves with
+    the lines of another worker (print() writes the text and the newline separately).
+    '''
+    def __init__(self, fd):
+        self.fd = fd
+        self.pending = ""
+
+    def write(self, text):
+        self.pending += text
+        if "\n" in text:
+            lines, _, self.pending = self.pending.rpartition("\n")
+            os.write(self.fd, (lines + "\n").encode())
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            os.write(self.fd, self.pending.encode())
+            self.pending = ""
+
+
+def run_worker(servers, worker_id):
+    '''
+    Entry point of a worker process
+    '''
+    sys.stdout.flush()
+    sys.stdout = LineWriter(sys.stdout.fileno())
+    server = servers[worker_id]
+    for other in servers:
+        if other is not server:
+            other.sock.close()
+            other.control.close()
+    server.controls[worker_id].close() # a worker never hands over to itself
+    try:
+        server.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.close()
+
+
+def serve(dest, port, window, workers, **options):
+    '''
+    Runs the server as the given number of worker processes until interrupted.
+    options are the keyword arguments of each worker's Server.
+    '''
+    # the coordinator must outlive the workers, so it ignores the interrupt
+    manager = SyncManager()
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    context = multiprocessing.get_context("fork")
+    shared = SharedDirectory(manager, context)
+    channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+    for _, sending in channels:
+        sending.setblocking(False) # a full channel fails the handover, as UDP would
+    # bind every socket before any worker runs: the kernel picks the worker of a
+    # client from the current reuseport group, so the group must not change later
+    servers = [ShardedServer(dest, port, window, i, shared, channels, **options)
+               for i in range(workers)]
+    processes = [context.Process(target=run_worker, args=(servers, i))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # pass the interrupt on so every worker flushes its output
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join()
+        raise
+    finally:
+        manager.shutdown()
@@ -3,6 +3,10 @@ import os
 import time
 import util
 
+# inputs that act on the client process instead of being typed into it
+KILL = "kill" # kills it on the spot, as a crash would
+RESTART = "restart" # starts it again once it exited: it joins from the same address
+
 class BasicTest(object):
     def __init__(self, forwarder,test_name="Basic"):
         self.forwarder = forwarder
@@ -14,6 +18,9 @@ class BasicTest(object):
         self.last_time = time.time()
         self.time_interval = 0.5
         self.packets_processed = {"ack":0,"data":0,"start":0,"end":0}
+        self.server_args = [] # extra command line arguments of the server
+        self.client_args = [] # and of every client
+        self.timeout = None # seconds the test may take, None for the forwarder's
 
     def set_state(self):
         pass
@@ -31,10 +38,17 @@ class BasicTest(object):
         elif len(self.input) > 0:
             if time.time() - self.last_time > self.time_interval:
                 client, inpt = self.input[0]
+                if inpt == RESTART and self.forwarder.senders[client].poll() is None:
+                    return # still quitting, try again on the next tick
                 self.input_to_check.append((client, inpt))
                 self.input = self.input[1:]
-                self.forwarder.senders[client].stdin.write(inpt.encode())
-                self.forwarder.senders[client].stdin.flush()
+                if inpt == KILL:
+                    self.forwarder.kill(client)
+                elif inpt == RESTART:
+                    self.forwarder.restart(client)
+                else:
+                    self.forwarder.senders[client].stdin.write(inpt.encode())
+                    self.forwarder.senders[client].stdin.flush()
                 self.last_time = time.time()
         
         elif time.time() - self.last_time > 0.5:
@@ -101,6 +115,25 @@ class BasicTest(object):
         print("Test Passed")
         return True
 
+    def outputs_match(self, server_out, clients_out):
+        # True if the server printed every line of server_out, and each client every
+        # line of clients_out[client]; prints the verdict
+        for client in clients_out.keys():
+            with open("client_"+client) as f:
+                lines = list(map(lambda x: x.lower(), f.read().split('\n')))
+                for each_line in clients_out[client]:
+                    if each_line.lower() not in lines:
+                        print("Test Failed: Client output is not correct")
+                        return False
+        with open("server_out") as f:
+            lines = list(map(lambda x: x.lower(), f.read().split('\n')))
+            for each_line in server_out:
+                if each_line.lower() not in lines:
+                    print("Test Failed: Server Output is not correct")
+                    return False
+        print("Test Passed")
+        return True
+
     def files_are_the_same(self, file1, file2):
         return BasicTest.md5sum(file1) == BasicTest.md5sum(file2)
 
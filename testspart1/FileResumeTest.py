@@ -0,0 +1,71 @@
+import os
+
+from .BasicTest import *
+
+FILENAME = "resume_test_file"
+FRAGMENTS = 16 # of the file, at most util.FRAGMENT_SIZE bytes each
+
+
+class FileResumeTest(BasicTest):
+    '''
+    client1 crashes halfway through sending a file, joins again and sends it again:
+    the server resumes from what it kept. Then it sends it a third time, from the cache.
+    '''
+    def set_state(self):
+        self.num_of_clients = 2
+        self.client_stdin = {"client1": 1, "client2": 2}
+        with open(FILENAME, "w") as f:
+            for i in range(FRAGMENTS * util.FRAGMENT_SIZE // 64):
+                f.write("%063d\n" % i)
+        # client2 stays well within the idle timeout, the crashed client1 does not
+        self.server_args = ["--file-cache=1", "--idle-timeout=1"]
+        self.client_args = ["--heartbeat=0.2"]
+        self.time_interval = 2.0
+        self.timeout = 25.
+        send = ("client1", "file 1 client2 %s\n" % FILENAME)
+        self.input = [send, ("client1", KILL), ("client1", RESTART), send, send,
+                      ("client2", "list\n")]
+        self.data_sent = [] # data packets from client1 to the server, per send
+        self.kept = FRAGMENTS // 2 # of the first send, the others are lost
+        self.last_time = time.time()
+
+    def handle_packet(self):
+        # counting from each send of the file until the next input of client1
+        inputs = [inpt for client, inpt in self.input_to_check if client == "client1"]
+        sends = sum(1 for inpt in inputs if inpt.startswith("file"))
+        counting = inputs and inputs[-1].startswith("file")
+        for p, user in self.forwarder.in_queue:
+            msg_type = p.full_packet[:p.full_packet.index(b"|")].decode()
+            self.packets_processed[msg_type] += 1
+            if counting and user == "client1" and msg_type == "data" \
+                    and p.address == self.forwarder.receiver_addr:
+                while len(self.data_sent) < sends:
+                    self.data_sent.append(set())
+                if sends == 1 and len(self.data_sent[0]) >= self.kept \
+                        and p.full_packet not in self.data_sent[0]:
+                    continue
+                self.data_sent[sends - 1].add(p.full_packet)
+            self.forwarder.out_queue.append((p, user))
+        self.forwarder.in_queue = []
+
+    def result(self):
+        received = "client2_" + FILENAME
+        try:
+            server_out = ["join: client1", "join: client2", "file: client1",
+                          "disconnected: client1", "disconnected: client2"]
+            clients_out = {"client1": ["quitting"],
+                           "client2": ["file: client1: %s" % FILENAME, "quitting"]}
+            if not os.path.exists(received) or not self.files_are_the_same(FILENAME, received):
+                print("Test Failed: The file received is not the one sent")
+                return False
+            counts = [len(packets) for packets in self.data_sent]
+            if len(counts) != 3 or counts[1] > FRAGMENTS - self.kept // 2 \
+                    or counts[2] > FRAGMENTS // 4:
+                print("Test Failed: The file was not resumed or not cached, data packets sent: %s"
+                      % counts)
+                return False
+            return self.outputs_match(server_out, clients_out)
+        finally:
+            for filename in (FILENAME, received):
+                if os.path.exists(filename):
+                    os.remove(filename)
@@ -0,0 +1,39 @@
+import shutil
+import tempfile
+
+from .BasicTest import *
+
+
+class HistoryTest(BasicTest):
+    def set_state(self):
+        self.num_of_clients = 3
+        self.client_stdin = {"client1": 1, "client2": 2, "client3": 3}
+        self.history_dir = tempfile.mkdtemp(prefix="history-")
+        self.server_args = ["--history=" + self.history_dir]
+        self.input = [("client1", "msg 1 client2 First one\n"),
+                      ("client3", "msg 1 client2 From client3\n"),
+                      ("client1", "msg 2 client2 client3 Second one\n"),
+                      ("client1", "msg 1 client3 Third one\n"),
+                      ("client2", "history\n"),
+                      ("client3", "history 1 client1\n"),
+                      ("client1", "history\n")]
+        self.last_time = time.time()
+
+    def result(self):
+        shutil.rmtree(self.history_dir, ignore_errors=True)
+        server_out = ["join: client1", "join: client2", "join: client3",
+                      "request_history: client2", "request_history: client3",
+                      "request_history: client1"]
+        clients_out = {"client1": ["history: no messages", "quitting"],
+                       "client2": ["history: client1: First one",
+                                   "history: client3: From client3",
+                                   "history: client1: Second one", "quitting"],
+                       "client3": ["history: client1: Third one", "quitting"]}
+        if not self.outputs_match(server_out, clients_out):
+            return False
+        # client3 asked for its last message from client1 only
+        with open("client_client3") as f:
+            if "history: client1: second one" in f.read().lower():
+                print("Test Failed: Client output is not correct")
+                return False
+        return True
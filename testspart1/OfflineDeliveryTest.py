@@ -0,0 +1,26 @@
+import shutil
+import tempfile
+
+from .BasicTest import *
+
+
+class OfflineDeliveryTest(BasicTest):
+    def set_state(self):
+        self.num_of_clients = 2
+        self.client_stdin = {"client1": 1, "client2": 2}
+        self.queue_dir = tempfile.mkdtemp(prefix="offline-")
+        self.server_args = ["--offline-queue=" + self.queue_dir]
+        self.input = [("client2", "quit\n"),
+                      ("client1", "msg 1 client2 Hello while you were away\n"),
+                      ("client1", "msg 1 client2 And again\n"),
+                      ("client2", RESTART)]
+        self.last_time = time.time()
+
+    def result(self):
+        shutil.rmtree(self.queue_dir, ignore_errors=True)
+        server_out = ["join: client1", "join: client2", "disconnected: client2",
+                      "msg: client1 to offline user client2", "disconnected: client1"]
+        clients_out = {"client1": ["quitting"],
+                       "client2": ["msg: client1: Hello while you were away",
+                                   "msg: client1: And again", "quitting"]}
+        return self.outputs_match(server_out, clients_out)
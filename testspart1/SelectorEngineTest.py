@@ -0,0 +1,7 @@
+from .MultipleClientsTest import *
+
+
+class SelectorEngineTest(MultipleClientsTest):
+    def set_state(self):
+        MultipleClientsTest.set_state(self)
+        self.client_args = ["--engine=selector"]
@@ -0,0 +1,7 @@
+from .MultipleClientsTest import *
+
+
+class WorkersTest(MultipleClientsTest):
+    def set_state(self):
+        MultipleClientsTest.set_state(self)
+        self.server_args = ["--workers=2"]
@@ -0,0 +1,56 @@
+'''
+This module implements a hashed timing wheel.
+
+Time is cut into ticks of `resolution` seconds and every scheduled item goes into
+the bucket of the tick it is due at, modulo the number of buckets. Scheduling is
+an append and expire() only visits the buckets of the ticks that passed since the
+previous call, so the cost does not depend on how many items are waiting. Items
+due further away than one turn of the wheel share a bucket with nearer ones and
+are kept until their own tick comes.
+'''
+
+
+class TimingWheel:
+    '''
+    Hashed timing wheel of arbitrary items.
+    '''
+    def __init__(self, resolution, slots, now):
+        self.resolution = resolution # seconds per tick
+        self.buckets = [[] for _ in range(slots)] # lists of (due tick, item)
+        self.tick = int(now / resolution) # last tick expire() went through
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, item, deadline):
+        '''
+        Adds an item that expire() returns once deadline passed
+        '''
+        due = max(int(deadline / self.resolution) + 1, self.tick + 1) # never early
+        self.buckets[due % len(self.buckets)].append((due, item))
+        self.count += 1
+
+    def expire(self, now):
+        '''
+        Removes and returns the items whose deadline passed
+        '''
+        target = int(now / self.resolution)
+        if target <= self.tick:
+            return []
+        expired = []
+        slots = len(self.buckets)
+        for tick in range(self.tick + 1, min(target, self.tick + slots) + 1):
+            bucket = self.buckets[tick % slots]
+            if not bucket:
+                continue
+            waiting = []
+            for entry in bucket:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    waiting.append(entry)
+            self.buckets[tick % slots] = waiting
+        self.tick = target
+        self.count -= len(expired)
+        return expired
@@ -0,0 +1,973 @@
+'''
+This module implements the reliable transport shared by the Client and the Server.
+
+Every message travels on its own connection: a start packet carrying a random
+initial sequence number and the length of the message in bytes, the data packets
+holding its fragments, and an end packet. The receiver answers
+every packet with a cumulative ack carrying the next sequence number it expects.
+Data packets are sent with selective repeat: up to `window` of them are in flight,
+each one is retransmitted on its own timer, and the receiver buffers packets that
+arrive out of order. Connections to the same peer are sent one after the other.
+
+The length a start packet announces is checked before anything is allocated for
+it: at most max_message bytes, and at most STRANGER_MESSAGE bytes (a join) from an
+address is_peer() does not know, whose reassembly state is dropped as soon as the
+message is complete; MAX_STRANGERS such messages are received at once at most.
+
+Messages waiting for the connection to a peer are held in a bounded queue, at
+most max_queued messages and max_queued_bytes bytes per peer. On overflow the
+"drop-oldest" policy discards the oldest waiting messages, "drop-newest" discards
+the new one and "disconnect" drops everything queued for the peer and reports it
+through on_overflow, so that one peer that stops acking cannot grow the memory of
+the sender. on_done, if set, learns the fate of every message sent: acknowledged by
+the peer, or given up on after MAX_RETRANSMISSIONS, dropped from the queue or forgotten.
+
+Optionally, small messages are coalesced (Nagle-style): messages that queued up
+behind the connection in flight go out together as one util.make_batch() message
+once it closes, and a small message to an idle peer waits up to coalesce_delay for
+company (a delay of 0 only batches the queued messages). A batch fits in one data
+packet. The extra latency is at most
+coalesce_delay for a message to an idle peer and none for queued messages, which
+waited for the connection anyway.
+
+A message sent to several peers is serialised once: all of its connections share
+the same initial sequence number, so every peer is sent the very same packets.
+
+Acks carry the ranges of packets received above the cumulative point (SACK blocks,
+see util.make_sack()), and the sender only retransmits the packets in between. It
+does not wait for their timers either: a hole is taken as lost, and sent again at
+once, when LOSS_THRESHOLD packets sent after it were reported received. That
+holds for a lost retransmission too, so only a loss at the tail of a message waits
+for its timer.
+
+Optionally, acks are delayed: in-order data is acked every second packet or after
+ACK_DELAY, and the ack of a complete message waits for ACK_DELAY too. A pending ack
+rides along in the seqno field of the next text packet sent to the same peer, such
+as the start of a reply (util.piggyback_ack()). This is off by default: the test
+harness expects an ack for every packet.
+
+The timers (retransmissions, delayed acks, coalescing delays) are kept in a heap of
+deadlines, one per connection for its retransmissions, so that tick() and
+next_timeout() only look at what is due instead of every packet in flight. Entries
+are not removed when their timer changes: one that no longer matches the state of
+its peer is skipped when it comes up, and a connection whose deadline moved later is
+looked at early and scheduled again.
+
+Each peer has its own retransmission timeout, estimated from the time its acks
+take to come back (Jacobson/Karels smoothed RTT and variance, RFC 6298). Packets
+that were retransmitted give no sample (Karn's rule). Every timeout doubles the
+peer's timeout until an ack of new data arrives.
+
+Packets use the text framing of util.make_packet() unless the peer negotiated the
+binary framing of util.make_binary_packet(). Received packets may use either.
+
+Messages of at least util.COMPRESS_THRESHOLD bytes to a peer that negotiated
+compression go through zlib when that makes them smaller, and their start packet
+says so (util.COMPRESSED_FLAG). Fragments and checksums cover the compressed bytes,
+as they travel; the receiver inflates the message once it is complete, to at most
+max_message bytes (STRANGER_MESSAGE from a stranger): a message that would inflate
+further counts as corrupted. Received
+messages may be compressed or not, whatever was negotiated.
+
+A streamed message, such as a file (see filetransfer.py), carries a header message
+in its start packet (util.STREAM_FLAG) and its bulk in the data packets. The bulk
+is any bytes-like object, typically an mmap, and each data packet is cut from it
+when it is sent. The receiver asks on_stream for a sink to write the bulk into,
+and hands over the header once all of it arrived. The start packet may carry a
+digest of the bulk; a sink that already holds the beginning of the bulk, say from
+an interrupted transfer, has it acked with the start packet, and the sender goes on
+from there.
+'''
+import heapq
+import random
+import threading
+import time
+from collections import deque, OrderedDict
+import zlib
+import util
+
+MAX_RETRANSMISSIONS = 10 # give up on a connection after this many resends of a packet
+MIN_RTO = util.TIME_OUT / 25 # bounds of the adaptive retransmission timeout, in seconds
+MAX_RTO = util.TIME_OUT * 120
+ACK_DELAY = MIN_RTO / 2 # longest a delayed ack waits, well below any retransmission timeout
+MAX_QUEUED_MESSAGES = 256 # default bounds of the queue of messages waiting for a peer
+MAX_QUEUED_BYTES = 1 << 20
+OVERFLOW_POLICIES = ("drop-oldest", "drop-newest", "disconnect")
+COALESCE_DELAY = MIN_RTO / 4 # longest a small message waits for others to the same peer
+COALESCE_SIZE = util.FRAGMENT_SIZE # bytes of a batch, so that it fits one data packet
+# kinds of timers in the heap
+ACK_TIMER, HOLD_TIMER, RETRANSMIT_TIMER = 0, 1, 2
+STRANGER_MESSAGE = util.FRAGMENT_SIZE # longest message from a peer is_peer() rejects, a join
+MAX_STRANGERS = 1024 # messages being received from such peers at once
+LOSS_THRESHOLD = 2 # packets sent after a hole and reported received that have it resent
+
+
+class Encoded:
+    '''
+    A message serialised into the packets of one connection. Index 0 of the packets
+    is the start packet, 1..n are data packets and n+1 is the end packet; index i
+    carries sequence number isn+i. The packets of each framing, compressed or not, and
+    the compressed payload are built on first use; those of a streamed message are
+    built one by one as they are sent.
+    '''
+    __slots__ = ("isn", "payload", "header", "digest", "held", "deflated", "variants", "parts")
+
+    def __init__(self, message, header=None, digest=None):
+        self.isn = random.randint(0, 1 << 24)
+        self.payload = message if not isinstance(message, str) else message.encode()
+        self.header = header # message carried by the start packet of a streamed message
+        self.digest = digest # hex digest of the bulk of a streamed message, or None
+        # bytes of memory the message holds while queued
+        self.held = len(self.payload) if header is None else len(header)
+        self.deflated = None # compressed payload, b"" when compression does not pay
+        self.variants = {} # (binary, compressed) : packets
+        self.parts = None # encoded messages a batch carries
+
+    def batchable(self):
+        '''
+        Returns True if the message may share a batch with others
+        '''
+        return self.header is None and len(self.payload) < COALESCE_SIZE
+
+    def compressed(self):
+        '''
+        Returns the payload compressed by zlib, or None if it is too small to bother
+        or does not get smaller
+        '''
+        if self.deflated is None:
+            self.deflated = b""
+            if self.header is None and len(self.payload) >= util.COMPRESS_THRESHOLD:
+                deflated = zlib.compress(self.payload, util.COMPRESS_LEVEL)
+                if len(deflated) < len(self.payload):
+                    self.deflated = deflated
+        return self.deflated or None
+
+    def packets(self, binary=False, compress=False):
+        '''
+        Returns the packets in the text or binary framing, of the compressed payload
+        if compress is True and compressing pays
+        '''
+        payload = self.compressed() if compress else None
+        key = (binary, payload is not None)
+        packets = self.variants.get(key)
+        if packets is None:
+            make = util.make_binary_packet if binary else util.make_packet_bytes
+            isn = self.isn
+            if self.header is not None:
+                start = b"%d%s" % (len(self.payload), util.STREAM_FLAG)
+                if self.digest is not None:
+                    start += util.DIGEST_FIELD + self.digest.encode()
+                start += b" " + self.header
+                packets = self.variants[key] = _StreamPackets(make, isn, start, self.payload)
+                return packets
+            if payload is None:
+                payload = self.payload
+                start = b"%d" % len(payload)
+            else:
+                start = b"%d%s" % (len(payload), util.COMPRESSED_FLAG)
+            packets = [make(util.START_PACKET_TYPE, isn, start)]
+            for i, chunk in enumerate(util.fragment(payload)):
+                packets.append(make(util.DATA_PACKET_TYPE, isn + 1 + i, chunk))
+            packets.append(make(util.END_PACKET_TYPE, isn + len(packets)))
+            self.variants[key] = packets
+        return packets
+
+
+class _StreamPackets:
+    '''
+    The packets of a streamed message, as a sequence whose data packets are built
+    from the bulk each time they are asked for.
+    '''
+    __slots__ = ("make", "isn", "start", "bulk", "count")
+
+    def __init__(self, make, isn, start, bulk):
+        self.make = make
+        self.isn = isn
+        self.start = make(util.START_PACKET_TYPE, isn, start)
+        self.bulk = bulk
+        self.count = max(1, -(-len(bulk) // util.FRAGMENT_SIZE)) # data packets
+
+    def __len__(self):
+        return self.count + 2
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.start
+        if index == self.count + 1:
+            return self.make(util.END_PACKET_TYPE, self.isn + index)
+        offset = (index - 1) * util.FRAGMENT_SIZE
+        with memoryview(self.bulk) as view:
+            return self.make(util.DATA_PACKET_TYPE, self.isn + index,
+                             view[offset:offset + util.FRAGMENT_SIZE])
+
+
+def encode(message):
+    '''
+    Serialises a message for one or more connections
+    '''
+    return Encoded(message)
+
+
+def encode_stream(header, bulk, digest=None):
+    '''
+    Serialises a streamed message: the header message and its bulk, a bytes-like
+    object that is only read as its packets are sent, with the hex digest of the bulk.
+    Raises ValueError if the header is longer than util.MAX_STREAM_HEADER bytes: it
+    would not fit in the start packet.
+    '''
+    header = header if isinstance(header, bytes) else header.encode()
+    if len(header) > util.MAX_STREAM_HEADER:
+        raise ValueError("stream header of %d bytes" % len(header))
+    return Encoded(bulk, header, digest)
+
+
+class _RttEstimator:
+    '''
+    Round trip time estimate and retransmission timeout of one peer.
+    '''
+    __slots__ = ("srtt", "rttvar", "estimate", "rto", "samples", "backoffs")
+
+    def __init__(self, rto):
+        self.srtt = None
+        self.rttvar = None
+        self.estimate = rto # timeout before any backoff
+        self.rto = rto
+        self.samples = 0
+        self.backoffs = 0
+
+    def sample(self, rtt):
+        '''
+        Folds one measured round trip time into the estimate
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.estimate = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        self.rto = self.estimate
+        self.samples += 1
+
+    def backoff(self):
+        '''
+        Doubles the timeout after a retransmission
+        '''
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self.backoffs += 1
+
+    def restore(self):
+        '''
+        Undoes the backoff once the peer acknowledges new data again
+        '''
+        self.rto = self.estimate
+
+
+class _Outgoing:
+    '''
+    Sender side of one connection, over packets made by encode() that may be
+    shared with the connections of other peers.
+    '''
+    __slots__ = ("address", "encoded", "isn", "packets", "base", "next", "sent_at", "retries",
+                 "sacked", "rtt", "resumable", "scheduled")
+
+    def __init__(self, address, encoded, binary, compress, rtt):
+        self.address = address
+        self.encoded = encoded
+        self.rtt = rtt # _RttEstimator of the peer
+        self.isn = encoded.isn
+        self.packets = encoded.packets(binary, compress)
+        # a receiver may hold part of a streamed message with a digest already
+        self.resumable = encoded.digest is not None
+        self.base = 0 # first unacknowledged packet
+        self.next = 0 # first packet never sent
+        self.sent_at = {} # index : time of the last (re)transmission
+        self.retries = {} # index : number of retransmissions
+        self.sacked = set() # indexes above base the receiver reported as received
+        self.scheduled = None # due time of its entry in the timer heap
+
+    def deadline(self):
+        '''
+        Returns the time the first packet in flight is due for retransmission, or None
+        '''
+        rto = self.rtt.rto
+        deadline = None
+        for i in range(self.base, self.next):
+            if i in self.sacked:
+                continue
+            due = self.sent_at[i] + rto
+            if deadline is None or due < deadline:
+                deadline = due
+        return deadline
+
+    def limit(self, window):
+        '''
+        Returns the index one past the last packet that may be in flight
+        '''
+        last_data = len(self.packets) - 2
+        if self.base == 0:
+            return 1 # the start packet goes alone
+        if self.base <= last_data:
+            return min(self.base + window, last_data + 1)
+        return len(self.packets) # all data acked, the end packet may go
+
+    def done(self):
+        return self.base == len(self.packets)
+
+
+class _Incoming:
+    '''
+    Receiver side of one connection.
+    '''
+    __slots__ = ("isn", "expected", "out_of_order", "payload", "compressed", "header",
+                 "delivered")
+
+    def __init__(self, isn, length, compressed=False, header=None, sink=None):
+        self.isn = isn
+        self.expected = isn + 1 # next in-order sequence number
+        self.out_of_order = set() # seqnos above expected that were already stored
+        # the bulk of a streamed message goes to the sink on_stream gave
+        self.payload = sink if sink is not None else util.Reassembler(length)
+        self.compressed = compressed # the payload has to go through zlib once complete
+        self.header = header # header of a streamed message
+        self.delivered = False
+
+
+class ReliableTransport:
+    '''
+    Reliable, in-order message delivery over a UDP socket.
+    The owner of the socket feeds every received datagram to handle_packet() and calls
+    tick() whenever next_timeout() expires. Both methods are safe to call from a
+    different thread than send().
+    '''
+    def __init__(self, sock, window, adaptive=True, sack=True, delayed_ack=False,
+                 max_queued=MAX_QUEUED_MESSAGES, max_queued_bytes=MAX_QUEUED_BYTES,
+                 overflow="drop-oldest", coalesce=False, coalesce_delay=COALESCE_DELAY,
+                 max_message=util.MAX_MESSAGE_SIZE):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy %r" % overflow)
+        self.sock = sock
+        self.window = max(1, int(window))
+        self.lock = threading.RLock()
+        self.outgoing = {} # address : _Outgoing currently in flight
+        self.queued = {} # address : deque of encoded messages waiting for the connection
+        self.queued_bytes = {} # address : payload bytes in its queue
+        self.max_queued = max_queued
+        self.max_queued_bytes = max_queued_bytes
+        self.overflow = overflow
+        self.on_overflow = None # called with the address a "disconnect" overflow dropped
+        # called with (address, encoded, acked) once a message sent to address was
+        # acknowledged, acked True, or will never be, acked False
+        self.on_done = None
+        self.coalesce = coalesce
+        self.coalesce_delay = coalesce_delay
+        self.holding = {} # address : time its queue is sent even if the batch is not full
+        self.incoming = {} # address : _Incoming
+        self.max_message = max_message
+        # called with an address, returns False for a peer that may only send a join;
+        # None trusts every address
+        self.is_peer = None
+        self.strangers = OrderedDict() # addresses is_peer() rejected with a message incoming
+        self.last_isn = {} # address : isn of the last connection opened to it
+        self.adaptive = adaptive # False retransmits after the fixed util.TIME_OUT
+        self.rtt = {} # address : _RttEstimator
+        self.sack = sack # False sends plain cumulative acks
+        self.delayed_ack = delayed_ack
+        self.pending_acks = {} # address : [deadline, seqno, data packets covered]
+        self.timers = [] # heap of (due time, kind, address), see _live()
+        self.binary_peers = set() # addresses that use the binary framing
+        self.accept_binary = False # switch a peer to binary framing when it sends binary packets
+        self.compress_peers = set() # addresses that negotiated compression
+        # called with (address, header, length, digest) when a streamed message starts;
+        # returns the sink its bulk is written to, or None to refuse it. The sink is
+        # like util.Reassembler, plus prefix(): how many fragments it holds already
+        self.on_stream = None
+        self.corrupted = 0 # packets dropped for a bad checksum
+        self.retransmitted = 0 # packets sent again after a timeout or a fast retransmit
+        self.fast_retransmitted = 0 # of them, packets sent again for SACK blocks
+        self.data_received = 0 # data packets received
+        self.acks_sent = 0 # ack packets sent, keepalives excluded
+        self.acks_piggybacked = 0 # acks sent inside an outgoing packet instead
+        self.max_depth = 0 # most messages ever queued for one peer
+        self.dropped = 0 # queued messages discarded by the overflow policy
+        self.overflows = 0
+        self.batches = 0 # batch messages sent
+        self.batched = 0 # messages sent inside them
+        self.skipped = 0 # data packets never sent because the receiver held them already
+        self.compressed_sent = 0 # messages sent compressed
+        self.compressed_received = 0
+        self.bytes_saved = 0 # payload bytes compression kept off the wire
+
+    def send(self, address, message):
+        '''
+        Queues a message for reliable delivery to address, returns it encoded as
+        on_done will report it
+        '''
+        return self.send_many((address,), message)
+
+    def send_many(self, addresses, message):
+        '''
+        Queues a message for reliable delivery to each of the addresses.
+        The packets are built once and shared by all of them.
+        '''
+        encoded = encode(message)
+        with self.lock:
+            for address in addresses:
+                self._submit(address, encoded)
+        return encoded
+
+    def send_stream(self, addresses, header, bulk, digest=None):
+        '''
+        Queues a streamed message for reliable delivery to each of the addresses,
+        see encode_stream(), which may raise ValueError. The bulk must not change until
+        every peer acknowledged it.
+        '''
+        encoded = encode_stream(header, bulk, digest)
+        with self.lock:
+            for address in addresses:
+                self._submit(address, encoded)
+
+    def send_encoded(self, address, variants):
+        '''
+        Queues a message that was already serialised by encode(), to reuse its packets.
+        variants holds encodings of the same message with different isns: a peer must
+        never get two connections in a row with the same isn, so the first variant
+        whose isn differs from the previous connection to address is used.
+        '''
+        with self.lock:
+            queue = self.queued.get(address)
+            previous = queue[-1].isn if queue else self.last_isn.get(address)
+            encoded = variants[0] if variants[0].isn != previous else variants[1]
+            self._submit(address, encoded)
+
+    def set_binary(self, address):
+        '''
+        Sends to address in the binary framing from now on
+        '''
+        with self.lock:
+            self.binary_peers.add(address)
+
+    def set_compress(self, address):
+        '''
+        Compresses the large messages to address from now on
+        '''
+        with self.lock:
+            self.compress_peers.add(address)
+
+    def keepalive(self, address):
+        '''
+        Sends address a packet that only shows we are still there: an ack of sequence
+        number 0, which acknowledges nothing
+        '''
+        with self.lock:
+            self.sock.sendto(self._ack_packet(address, 0), address)
+
+    def pending(self, address):
+        '''
+        Returns the number of messages to address that are queued or in flight
+        '''
+        with self.lock:
+            return len(self.queued.get(address, ())) + (address in self.outgoing)
+
+    def busy(self):
+        '''
+        Returns True while some message has not been acknowledged yet
+        '''
+        with self.lock:
+            return bool(self.outgoing)
+
+    def forget(self, address):
+        '''
+        Drops every queued message for address, and what was being received from it.
+        A message it completes later is acked all the same, see _handle_end().
+        '''
+        with self.lock:
+            conn = self.outgoing.pop(address, None)
+            queue = self.queued.pop(address, None)
+            if self.on_done is not None:
+                if conn is not None:
+                    self._done(address, conn.encoded, False)
+                for encoded in queue or ():
+                    self._done(address, encoded, False)
+            self.queued_bytes.pop(address, None)
+            self.holding.pop(address, None)
+            self.last_isn.pop(address, None)
+            self.rtt.pop(address, None)
+            self.pending_acks.pop(address, None)
+            self.binary_peers.discard(address)
+            self.compress_peers.discard(address)
+            self.incoming.pop(address, None)
+            self.strangers.pop(address, None)
+
+    def rtt_stats(self, address):
+        '''
+        Returns the round trip time estimate of a peer, in seconds, or None
+        '''
+        with self.lock:
+            rtt = self.rtt.get(address)
+            if rtt is None:
+                return None
+            return {"srtt": rtt.srtt, "rttvar": rtt.rttvar, "rto": rtt.rto,
+                    "samples": rtt.samples, "backoffs": rtt.backoffs}
+
+    def queue_stats(self):
+        '''
+        Returns the depth of the outbound queues and the overflow counters
+        '''
+        with self.lock:
+            return {"peers": len(self.queued),
+                    "messages": sum(len(queue) for queue in self.queued.values()),
+                    "bytes": sum(self.queued_bytes.values()),
+                    "deepest": max((len(queue) for queue in self.queued.values()), default=0),
+                    "max_depth": self.max_depth, "dropped": self.dropped,
+                    "overflows": self.overflows}
+
+    def ack_stats(self):
+        '''
+        Returns the acknowledgement counters and the acks per data packet received
+        '''
+        with self.lock:
+            acks = self.acks_sent + self.acks_piggybacked
+            return {"data_received": self.data_received, "acks_sent": self.acks_sent,
+                    "acks_piggybacked": self.acks_piggybacked,
+                    "acks_per_data": acks / self.data_received if self.data_received else 0.0}
+
+    def compression_stats(self):
+        '''
+        Returns the compression counters
+        '''
+        with self.lock:
+            return {"peers": len(self.compress_peers), "sent": self.compressed_sent,
+                    "received": self.compressed_received, "bytes_saved": self.bytes_saved}
+
+    def handle_packet(self, raw, address, length=None):
+        '''
+        Processes one received datagram, the first length bytes of raw if given.
+        Returns the bytes of the message it completed, or None.
+        '''
+        binary = util.is_binary_packet(raw)
+        ack = None
+        try:
+            if binary:
+                packet_type, seqno, data, checksum = util.parse_binary_packet(raw, length)
+                valid = util.binary_checksum(raw, data) == checksum
+            else:
+                valid = util.validate_checksum_bytes(raw, length)
+                packet_type, seqno, data, _ = util.parse_packet_bytes(raw, length)
+                seqno, ack = util.split_piggyback_ack(seqno)
+        except ValueError:
+            valid = False
+        if not valid:
+            self.corrupted += 1
+            return None
+        with self.lock:
+            if binary and self.accept_binary:
+                self.binary_peers.add(address)
+            if ack is not None:
+                self._handle_ack(address, ack, b"")
+            if packet_type == util.ACK_PACKET_TYPE:
+                self._handle_ack(address, seqno, data)
+                return None
+            if packet_type == util.START_PACKET_TYPE:
+                self._handle_start(address, seqno, data)
+            elif packet_type == util.DATA_PACKET_TYPE:
+                self._handle_data(address, seqno, data)
+            elif packet_type == util.END_PACKET_TYPE:
+                return self._handle_end(address, seqno)
+        return None
+
+    def tick(self, now=None):
+        '''
+        Retransmits every packet whose timer expired and sends the delayed acks that are due
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            timers = self.timers
+            while timers and timers[0][0] <= now:
+                entry = heapq.heappop(timers)
+                if not self._live(entry):
+                    continue
+                _, kind, address = entry
+                if kind == ACK_TIMER:
+                    self._ack(address, self.pending_acks[address][1])
+                elif kind == HOLD_TIMER:
+                    del self.holding[address]
+                    self._open_next(address)
+                else:
+                    conn = self.outgoing[address]
+                    conn.scheduled = None
+                    self._retransmit(conn, now)
+                    if self.outgoing.get(address) is conn:
+                        self._schedule(conn)
+
+    def _retransmit(self, conn, now):
+        # resends the packets of conn whose timer expired
+        rto = conn.rtt.rto
+        expired = False
+        for i in range(conn.base, conn.next):
+            if now - conn.sent_at[i] < rto or i in conn.sacked:
+                continue
+            retries = conn.retries.get(i, 0)
+            if retries >= MAX_RETRANSMISSIONS:
+                self._close(conn, False)
+                return
+            conn.retries[i] = retries + 1
+            self.retransmitted += 1
+            self._transmit(conn, i, now)
+            expired = True
+        if expired and self.adaptive:
+            conn.rtt.backoff() # once per timeout, however many packets it hit
+
+    def _fast_retransmit(self, conn):
+        # resends at once the holes that LOSS_THRESHOLD packets sent after them overtook.
+        # Packets sent at the same time went out by increasing index.
+        sent_at = conn.sent_at
+        overtaken = heapq.nlargest(LOSS_THRESHOLD, ((sent_at[i], i) for i in conn.sacked))[-1]
+        now = time.time()
+        for i in range(conn.base, max(conn.sacked)):
+            retries = conn.retries.get(i, 0)
+            if i in conn.sacked or (sent_at[i], i) >= overtaken \
+                    or retries >= MAX_RETRANSMISSIONS:
+                continue # not lost yet, or the timer gives up on it
+            conn.retries[i] = retries + 1
+            self.retransmitted += 1
+            self.fast_retransmitted += 1
+            self._transmit(conn, i, now)
+
+    def _live(self, entry):
+        # False for a timer entry that no longer matches the state of its peer
+        due, kind, address = entry
+        if kind == ACK_TIMER:
+            pending = self.pending_acks.get(address)
+            return pending is not None and pending[0] == due
+        if kind == HOLD_TIMER:
+            return self.holding.get(address) == due
+        conn = self.outgoing.get(address)
+        return conn is not None and conn.scheduled == due
+
+    def _schedule(self, conn):
+        # has the timer heap look at conn by its retransmission deadline
+        deadline = conn.deadline()
+        if deadline is not None and (conn.scheduled is None or deadline < conn.scheduled):
+            conn.scheduled = deadline
+            heapq.heappush(self.timers, (deadline, RETRANSMIT_TIMER, conn.address))
+
+    def next_timeout(self, now=None):
+        '''
+        Returns the number of seconds until the next retransmission is due, or None
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            timers = self.timers
+            while timers and not self._live(timers[0]):
+                heapq.heappop(timers)
+            if not timers:
+                return None
+            return max(0.0, timers[0][0] - now)
+
+    # sender side
+
+    def _open(self, address, encoded):
+        rtt = self.rtt.get(address)
+        if rtt is None:
+            rtt = self.rtt[address] = _RttEstimator(util.TIME_OUT)
+        compress = address in self.compress_peers
+        conn = _Outgoing(address, encoded, address in self.binary_peers, compress, rtt)
+        if compress and encoded.compressed() is not None:
+            self.compressed_sent += 1
+            self.bytes_saved += len(encoded.payload) - len(encoded.deflated)
+        self.outgoing[address] = conn
+        self.last_isn[address] = conn.isn
+        self._fill(conn)
+
+    def _submit(self, address, encoded):
+        if address in self.holding:
+            self._enqueue(address, encoded)
+            if address in self.holding and (self.queued_bytes[address] >= COALESCE_SIZE
+                                            or not encoded.batchable()):
+                del self.holding[address] # full, no point waiting
+                self._open_next(address)
+        elif address in self.outgoing:
+            self._enqueue(address, encoded)
+        elif self.coalesce and self.coalesce_delay and encoded.batchable():
+            self._enqueue(address, encoded)
+            deadline = self.holding[address] = time.time() + self.coalesce_delay
+            heapq.heappush(self.timers, (deadline, HOLD_TIMER, address))
+        else:
+            self._open(address, encoded)
+
+    def _enqueue(self, address, encoded):
+        queue = self.queued.get(address)
+        if queue is None:
+            queue = self.queued[address] = deque()
+            self.queued_bytes[address] = 0
+        size = encoded.held
+        full = len(queue) >= self.max_queued
+        if full or self.queued_bytes[address] + size > self.max_queued_bytes:
+            self.overflows += 1
+            if self.overflow == "drop-newest":
+                self.dropped += 1
+                self._done(address, encoded, False)
+                return
+            if self.overflow == "disconnect":
+                self.dropped += len(queue) + 1
+                self._done(address, encoded, False)
+                self.forget(address)
+                if self.on_overflow is not None:
+                    self.on_overflow(address)
+                return
+            while queue and (len(queue) >= self.max_queued
+                             or self.queued_bytes[address] + size > self.max_queued_bytes):
+                dropped = queue.popleft()
+                self.queued_bytes[address] -= dropped.held
+                self.dropped += 1
+                self._done(address, dropped, False)
+        queue.append(encoded)
+        self.queued_bytes[address] += size
+        if len(queue) > self.max_depth:
+            self.max_depth = len(queue)
+
+    def _close(self, conn, acked=True):
+        address = conn.address
+        del self.outgoing[address]
+        self._done(address, conn.encoded, acked)
+        self._open_next(address)
+        if address not in self.outgoing and self.is_peer is not None \
+                and not self.is_peer(address):
+            # a stranger answered with an error: keep nothing of it around
+            self.last_isn.pop(address, None)
+            self.rtt.pop(address, None)
+
+    def _done(self, address, encoded, acked):
+        if self.on_done is None:
+            return
+        for part in encoded.parts or (encoded,):
+            self.on_done(address, part, acked)
+
+    def _open_next(self, address):
+        # opens the connection for the next queued message, or batch of them
+        queue = self.queued.get(address)
+        if queue:
+            encoded = queue.popleft()
+            self.queued_bytes[address] -= encoded.held
+            if self.coalesce and queue and encoded.batchable():
+                encoded = self._batch(address, encoded, queue)
+            self._open(address, encoded)
+        if queue is not None and not queue:
+            del self.queued[address]
+            del self.queued_bytes[address]
+
+    def _batch(self, address, first, queue):
+        # takes the queued messages that fit in one batch with the first one
+        parts = [first]
+        size = 16 + len(first.payload) # "batch <length> " and a length prefix
+        while queue and queue[0].batchable() \
+                and size + len(queue[0].payload) + 8 <= COALESCE_SIZE:
+            encoded = queue.popleft()
+            self.queued_bytes[address] -= encoded.held
+            parts.append(encoded)
+            size += len(encoded.payload) + 8
+        if len(parts) == 1:
+            return first # too large to share a packet, keeps its shared packets
+        self.batches += 1
+        self.batched += len(parts)
+        batch = Encoded(util.make_batch([part.payload for part in parts]))
+        batch.parts = parts
+        return batch
+
+    def _transmit(self, conn, index, now):
+        conn.sent_at[index] = now
+        packet = conn.packets[index]
+        if self.pending_acks and conn.address in self.pending_acks \
+                and conn.address not in self.binary_peers:
+            packet = util.piggyback_ack(packet, self.pending_acks.pop(conn.address)[1])
+            self.acks_piggybacked += 1
+        self.sock.sendto(packet, conn.address)
+
+    def _fill(self, conn):
+        now = time.time()
+        limit = conn.limit(self.window)
+        while conn.next < limit:
+            self._transmit(conn, conn.next, now)
+            conn.next += 1
+        self._schedule(conn)
+
+    def _handle_ack(self, address, seqno, sack):
+        conn = self.outgoing.get(address)
+        if conn is None:
+            return
+        acked = seqno - conn.isn
+        if acked > conn.next and conn.base == 0 and conn.resumable and acked < len(conn.packets):
+            # the start packet is acked past data never sent: the receiver holds it
+            # already, so sending goes on from there
+            self.skipped += acked - 1
+            conn.sent_at[acked - 1] = conn.sent_at[0]
+            conn.next = acked
+        if acked < conn.base or acked > conn.next:
+            return # stale or bogus ack
+        if acked > conn.base:
+            # the ack may have been triggered by a retransmission among the packets it
+            # covers, and then tells nothing about the round trip time
+            ambiguous = False
+            newest = conn.sent_at[acked - 1]
+            for i in range(conn.base, acked):
+                ambiguous = ambiguous or i in conn.retries
+                conn.sent_at.pop(i, None)
+                conn.sacked.discard(i)
+            if self.adaptive:
+                if ambiguous:
+                    conn.rtt.restore()
+                else:
+                    conn.rtt.sample(time.time() - newest)
+            conn.base = acked
+        if sack:
+            try:
+                blocks = util.parse_sack(sack)
+            except ValueError:
+                blocks = ()
+            for start, end in blocks:
+                conn.sacked.update(range(max(start - conn.isn, conn.base + 1),
+                                         min(end - conn.isn + 1, conn.next)))
+            if len(conn.sacked) >= LOSS_THRESHOLD:
+                self._fast_retransmit(conn)
+        if conn.done():
+            self._close(conn)
+        else:
+            self._fill(conn)
+
+    # receiver side
+
+    def _ack_packet(self, address, seqno, sack=b""):
+        if address in self.binary_peers:
+            return util.make_binary_packet(util.ACK_PACKET_TYPE, seqno, sack)
+        return util.make_packet_bytes(util.ACK_PACKET_TYPE, seqno, sack)
+
+    def _ack(self, address, seqno, conn=None):
+        # conn is the connection whose out of order packets are reported in SACK blocks
+        self.pending_acks.pop(address, None) # superseded
+        sack = b""
+        if self.sack and conn is not None and conn.out_of_order:
+            sack = util.make_sack(conn.out_of_order)
+        self.sock.sendto(self._ack_packet(address, seqno, sack), address)
+        self.acks_sent += 1
+
+    def _delay_ack(self, address, seqno, data):
+        # data is True for the ack of a data packet, every second one goes right away
+        pending = self.pending_acks.get(address)
+        if pending is None:
+            pending = self.pending_acks[address] = [time.time() + ACK_DELAY, seqno, 0]
+            heapq.heappush(self.timers, (pending[0], ACK_TIMER, address))
+        pending[1] = seqno
+        if data:
+            pending[2] += 1
+            if pending[2] >= 2:
+                self._ack(address, seqno)
+
+    def _handle_start(self, address, seqno, data):
+        conn = self.incoming.get(address)
+        if conn is None or conn.isn != seqno:
+            # <length>, then flags such as ;z, then a header for streamed messages
+            prefix, _, header = bytes(data).partition(b" ")
+            fields = prefix.split(b";")
+            flags = [b";" + field for field in fields[1:]]
+            try:
+                length = int(fields[0] or b"0")
+            except ValueError:
+                return
+            streamed = util.STREAM_FLAG in flags
+            stranger = self.is_peer is not None and not self.is_peer(address)
+            if length < 0 or (not streamed and length > self.max_message) \
+                    or (stranger and (streamed or length > STRANGER_MESSAGE)):
+                return # never allocated, the sender gives up after its retransmissions
+            compressed = util.COMPRESSED_FLAG in flags
+            sink = None
+            if streamed:
+                digest = None
+                for flag in flags:
+                    if flag.startswith(util.DIGEST_FIELD):
+                        digest = flag[len(util.DIGEST_FIELD):].decode(errors="replace")
+                try:
+                    if self.on_stream is not None:
+                        sink = self.on_stream(address, header, length, digest)
+                except OSError:
+                    sink = None # no room for the file
+                if sink is None:
+                    # refused, the sender gives up after its retransmissions; or not
+                    # ready yet, and a retransmission finds it ready
+                    return
+            else:
+                header = None
+            try:
+                conn = _Incoming(seqno, length, compressed, header, sink)
+            except MemoryError:
+                return
+            if sink is not None:
+                conn.expected += sink.prefix() # resumed
+            self.incoming[address] = conn
+            if stranger:
+                self.strangers[address] = True
+                self.strangers.move_to_end(address)
+                while len(self.strangers) > MAX_STRANGERS:
+                    self.incoming.pop(self.strangers.popitem(last=False)[0], None)
+        self._ack(address, conn.expected)
+
+    def _handle_data(self, address, seqno, data):
+        conn = self.incoming.get(address)
+        if conn is None or seqno <= conn.isn:
+            return
+        self.data_received += 1
+        in_order = seqno == conn.expected and not conn.out_of_order
+        if seqno == conn.expected or (conn.expected < seqno < conn.expected + self.window
+                                      and seqno not in conn.out_of_order):
+            if not conn.payload.add(seqno - conn.isn - 1, data):
+                return
+            if seqno == conn.expected:
+                conn.expected += 1
+                while conn.expected in conn.out_of_order:
+                    conn.out_of_order.remove(conn.expected)
+                    conn.expected += 1
+            else:
+                conn.out_of_order.add(seqno)
+                in_order = False
+        else:
+            in_order = False # duplicate, its ack may have been lost
+        if self.delayed_ack and in_order:
+            self._delay_ack(address, conn.expected, True)
+        else:
+            self._ack(address, conn.expected, conn) # holes are reported at once
+
+    def _handle_end(self, address, seqno):
+        conn = self.incoming.get(address)
+        if conn is None or seqno < conn.expected:
+            # end of a connection that is already complete: the ack was lost
+            self._ack(address, seqno + 1)
+            return None
+        if seqno > conn.expected:
+            self._ack(address, conn.expected, conn) # data is still missing
+            return None
+        if self.delayed_ack and not conn.delivered:
+            self._delay_ack(address, seqno + 1, False) # a reply may carry it
+        else:
+            self._ack(address, seqno + 1)
+        if conn.delivered:
+            return None
+        conn.delivered = True
+        limit = self.max_message
+        if self.strangers.pop(address, None) is not None:
+            del self.incoming[address] # a late end is acked without it, see above
+            limit = STRANGER_MESSAGE
+        if conn.header is not None:
+            return conn.header
+        if not conn.compressed:
+            return conn.payload.buffer
+        try:
+            # no bigger than a message may be, whatever the sender compressed
+            inflater = zlib.decompressobj()
+            payload = inflater.decompress(conn.payload.buffer, limit + 1)
+            if len(payload) > limit or not inflater.eof:
+                raise zlib.error("inflates beyond the limit, or truncated")
+        except zlib.error:
+            self.corrupted += 1 # the checksums held, so the sender is at fault
+            return None
+        self.compressed_received += 1
+        return payload
@@ -2,12 +2,22 @@
 This file contains basic utility functions that you can use and can also make your helper functions here
 '''
 import binascii
+import struct
 
 MAX_NUM_CLIENTS = 10
 TIME_OUT = 0.5 # 500ms
 CHUNK_SIZE = 1400 # 1400 Bytes
+FRAGMENT_SIZE = CHUNK_SIZE - 64 # payload bytes per packet, leaves room for the header
+MAX_MESSAGE_SIZE = 4 << 20 # longest message a peer may send, streamed files excepted
+# longest header of a streamed message: it shares the start packet with the length,
+# the flags and a SHA-256 digest
+MAX_STREAM_HEADER = FRAGMENT_SIZE - 128
+IDLE_TIMEOUTS = 240 # the server drops a client not heard from for this many TIME_OUTs
+HEARTBEAT_TIMEOUTS = 60 # an idle client sends a keepalive every this many TIME_OUTs
 
 # additional utils
+BATCH_MESSAGE = "batch" # several small messages coalesced into one, see make_batch()
+
 START_PACKET_TYPE = "start"
 END_PACKET_TYPE = "end"
 ACK_PACKET_TYPE = "ack"
@@ -18,27 +28,101 @@ TYPE_TWO_MSG_FORMAT = 2
 TYPE_THREE_MSG_FORMAT = 3
 TYPE_FOUR_MSG_FORMAT = 4
 
+# binary framing: 1-byte type, 4-byte seqno, 2-byte body length, 4-byte CRC32, raw body.
+# The type codes are below any printable character, so text and binary packets
+# can always be told apart by their first byte.
+BINARY_HEADER = struct.Struct("!BIHI")
+BINARY_PREFIX = struct.Struct("!BIH") # the header up to the checksum
+BINARY_TYPES = {START_PACKET_TYPE: 1, DATA_PACKET_TYPE: 2, ACK_PACKET_TYPE: 3, END_PACKET_TYPE: 4}
+BINARY_TYPE_NAMES = {code: name for name, code in BINARY_TYPES.items()}
+BINARY_CAPABILITY = "binary" # added to the join message by clients that want binary framing
+
+# selective acknowledgement: the body of an ack may list ranges of sequence numbers
+# received above the cumulative ack, as `start-end` or `seqno`, separated by commas
+MAX_SACK_BLOCKS = 8
+
+# a text packet may carry an ack for the opposite direction in its seqno field,
+# e.g. `start|5031;a=812|12|<checksum>`
+PIGGYBACK_ACK = ";a="
+
+# compression: the body of a start packet is `<length>;z` when the message went
+# through zlib, <length> being the length of the compressed bytes on the wire
+COMPRESS_CAPABILITY = "deflate" # added to the join message by clients that want compression
+COMPRESSED_FLAG = b";z"
+COMPRESS_THRESHOLD = 256 # smaller messages are always sent as they are
+COMPRESS_LEVEL = 6
+
+# streamed messages: the body of a start packet is `<length>;f <header>`, where the
+# header is a whole message (e.g. a send_file) and <length> counts the bytes that
+# follow it in the data packets (e.g. the contents of the file). The flag may be
+# followed by the hex SHA-256 digest of those bytes, as in `<length>;f;h=<digest>`.
+STREAM_FLAG = b";f"
+DIGEST_FIELD = b";h="
+
 JOIN_MESSAGE = "join"
 REQUEST_USERS_LIST_MESSAGE = "request_users_list"
 RESPONSE_USERS_LIST_MESSAGE = "response_users_list"
 SEND_MESSAGE_MESSAGE = "send_message"
 FORWARD_MESSAGE_MESSAGE = "forward_message"
+SEND_FILE_MESSAGE = "send_file"
+FORWARD_FILE_MESSAGE = "forward_file"
+REQUEST_HISTORY_MESSAGE = "request_history"
+RESPONSE_HISTORY_MESSAGE = "response_history" # a page of forward_messages, see make_batch()
 DISCONNECT_MESSAGE = "disconnect"
 
 ERR_SERVER_FULL_MESSAGE = "err_server_full"
 ERR_USERNAME_UNAVAILABLE_MESSAGE = "err_username_unavailable"
+ERR_NOT_JOINED_MESSAGE = "err_not_joined" # a request from an address without a session
+ERR_FILE_FAILED_MESSAGE = "err_file_failed" # a file whose contents did not match its digest
 
 
 def validate_checksum(message):
     '''
     Validates Checksum of a message and returns true/false
     '''
+    if isinstance(message, str):
+        message = message.encode()
+    return validate_checksum_bytes(message)
+
+
+def validate_checksum_bytes(packet, length=None):
+    '''
+    Validates the checksum of a received text packet without decoding it.
+    Only the first length bytes of packet are used when length is given.
+    '''
+    if length is None:
+        last = packet.rfind(b'|')
+        checksum = packet[last + 1:]
+    else:
+        last = packet.rfind(b'|', 0, length)
+        checksum = packet[last + 1:length]
+    if last < 0:
+        return False
     try:
-        msg, checksum = message.rsplit('|', 1)
-        msg += '|'
-        return generate_checksum(msg.encode()) == checksum
-    except BaseException:
+        checksum = int(checksum)
+    except ValueError:
         return False
+    # slicing a packet-sized buffer is cheaper than setting up a memoryview for it
+    return binascii.crc32(packet[:last + 1]) & 0xffffffff == checksum
+
+
+def validate_binary_checksum(packet, length=None):
+    '''
+    Validates the checksum of a received binary packet
+    '''
+    try:
+        _, _, data, checksum = parse_binary_packet(packet, length)
+    except ValueError:
+        return False
+    return binary_checksum(packet, data) == checksum
+
+
+def binary_checksum(packet, data):
+    '''
+    Returns the CRC32 of a binary packet, given the body returned by parse_binary_packet()
+    '''
+    crc = binascii.crc32(memoryview(packet)[:BINARY_PREFIX.size])
+    return binascii.crc32(data, crc) & 0xffffffff
 
 
 def generate_checksum(message):
@@ -62,6 +146,15 @@ def make_packet(msg_type="data", seqno=0, msg=""):
     return packet
 
 
+def make_packet_bytes(msg_type="data", seqno=0, payload=b""):
+    '''
+    Same as make_packet() but builds the packet as bytes around a bytes-like payload,
+    so fragments of a larger message are never decoded or copied into a str.
+    '''
+    body = b"%s|%d|%s|" % (msg_type.encode(), seqno, payload)
+    return body + generate_checksum(body).encode()
+
+
 def parse_packet(message):
     '''
     This function will parse the packet in the same way it was made in the above function.
@@ -73,6 +166,163 @@ def parse_packet(message):
     return msg_type, seqno, data, checksum
 
 
+def parse_packet_bytes(packet, length=None):
+    '''
+    Same as parse_packet() but works on the received bytes.
+    Only the first length bytes of packet are used when length is given, so a
+    reusable receive buffer can be parsed in place.
+    The body is returned as a memoryview into packet, without copying it.
+    '''
+    if length is None:
+        length = len(packet)
+    first = packet.find(b'|', 0, length)
+    second = packet.find(b'|', first + 1, length)
+    last = packet.rfind(b'|', 0, length)
+    if first < 0 or second < 0:
+        raise ValueError("malformed packet")
+    msg_type = packet[:first].decode()
+    seqno = packet[first + 1:second].decode()
+    data = memoryview(packet)[second + 1:max(second + 1, last)]
+    checksum = packet[last + 1:length].decode()
+    return msg_type, seqno, data, checksum
+
+
+def make_binary_packet(msg_type="data", seqno=0, payload=b""):
+    '''
+    Binary counterpart of make_packet_bytes().
+    The CRC32 covers the header fields before it and the body.
+    '''
+    prefix = BINARY_PREFIX.pack(BINARY_TYPES[msg_type], seqno, len(payload))
+    checksum = binascii.crc32(payload, binascii.crc32(prefix)) & 0xffffffff
+    return b"".join((prefix, struct.pack("!I", checksum), payload))
+
+
+def is_binary_packet(packet):
+    '''
+    Returns True if packet uses the binary framing
+    '''
+    return len(packet) > 0 and packet[0] in BINARY_TYPE_NAMES
+
+
+def parse_binary_packet(packet, length=None):
+    '''
+    Binary counterpart of parse_packet_bytes(). The seqno and checksum are returned
+    as integers and the body as a memoryview into packet, without copying it.
+    '''
+    if length is None:
+        length = len(packet)
+    if length < BINARY_HEADER.size:
+        raise ValueError("malformed packet")
+    code, seqno, body_length, checksum = BINARY_HEADER.unpack_from(packet)
+    end = BINARY_HEADER.size + body_length
+    if end > length or code not in BINARY_TYPE_NAMES:
+        raise ValueError("malformed packet")
+    data = memoryview(packet)[BINARY_HEADER.size:end]
+    return BINARY_TYPE_NAMES[code], seqno, data, checksum
+
+
+def piggyback_ack(packet, ack):
+    '''
+    Returns a copy of a text packet that also acknowledges seqno ack
+    '''
+    first = packet.find(b'|')
+    second = packet.find(b'|', first + 1)
+    last = packet.rfind(b'|')
+    body = b"%s%s%d%s" % (packet[:second], PIGGYBACK_ACK.encode(), ack, packet[second:last + 1])
+    return body + generate_checksum(body).encode()
+
+
+def split_piggyback_ack(seqno):
+    '''
+    Returns the seqno and the piggybacked ack (None if there is none) of the seqno
+    field of a text packet, as integers
+    '''
+    seqno, _, ack = seqno.partition(PIGGYBACK_ACK)
+    return int(seqno), int(ack) if ack else None
+
+
+def make_sack(seqnos, limit=MAX_SACK_BLOCKS):
+    '''
+    Returns the ack body listing the received seqnos as at most limit ranges,
+    lowest first, e.g. b"12-14,17"
+    '''
+    blocks = []
+    start = end = None
+    for seqno in sorted(seqnos):
+        if start is not None and seqno == end + 1:
+            end = seqno
+            continue
+        if start is not None:
+            blocks.append(b"%d-%d" % (start, end) if end > start else b"%d" % start)
+            if len(blocks) == limit:
+                return b",".join(blocks)
+        start = end = seqno
+    if start is not None:
+        blocks.append(b"%d-%d" % (start, end) if end > start else b"%d" % start)
+    return b",".join(blocks)
+
+
+def parse_sack(body):
+    '''
+    Returns the (start, end) ranges, both included, of an ack body made by make_sack()
+    '''
+    blocks = []
+    for block in bytes(body).split(b","):
+        start, _, end = block.partition(b"-")
+        start = int(start)
+        blocks.append((start, int(end) if end else start))
+    return blocks
+
+
+def make_batch(payloads, command=BATCH_MESSAGE):
+    '''
+    Returns the batch message packing the given encoded messages:
+    `batch <length> <length_1> <message_1> ... <length_n> <message_n>`, lengths in bytes.
+    A page of history is packed the same way under another command.
+    '''
+    body = b" ".join(b"%d %s" % (len(payload), payload) for payload in payloads)
+    return b"%s %d %s" % (command.encode(), len(body), body)
+
+
+def fragment(payload, size=FRAGMENT_SIZE):
+    '''
+    Splits a bytes-like payload into numbered fragments of at most size bytes.
+    Fragment i is a memoryview of payload[i*size:(i+1)*size]; there is always at least one.
+    '''
+    view = memoryview(payload)
+    return [view[i:i + size] for i in range(0, len(view), size)] or [view[0:0]]
+
+
+class Reassembler:
+    '''
+    Rebuilds a payload from the fragments made by fragment().
+    The buffer is allocated once from the total length and every fragment is copied
+    straight to its offset, so fragments may arrive in any order.
+    '''
+    __slots__ = ("buffer", "size", "count", "received")
+
+    def __init__(self, total_length, size=FRAGMENT_SIZE):
+        self.buffer = bytearray(total_length)
+        self.size = size
+        self.count = max(1, -(-total_length // size)) # number of fragments expected
+        self.received = 0
+
+    def add(self, index, data):
+        '''
+        Stores fragment number index, which must not have been added before.
+        Returns False if it does not fit the payload.
+        '''
+        offset = index * self.size
+        if index >= self.count or offset + len(data) > len(self.buffer):
+            return False
+        self.buffer[offset:offset + len(data)] = data
+        self.received += 1
+        return True
+
+    def complete(self):
+        return self.received >= self.count
+
+
 def make_message(msg_type, msg_format, message=None):
     '''
     This function can be used to format your message according